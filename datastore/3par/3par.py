@@ -19,6 +19,7 @@
 
 from hpe3parclient import client, exceptions
 import argparse
+import os
 import time
 
 # ----------------------------
@@ -46,24 +47,46 @@ commonParser.add_argument('-i', '--ip', help='3PAR IP for SSH authentication opt
 commonParser.add_argument('-u', '--username', help='3PAR username', required=True)
 commonParser.add_argument('-p', '--password', help='3PAR password', required=True)
 commonParser.add_argument('-sd', '--softDelete', help='Soft-delete volumes/snapshots', type=boolarg, default=False)
+commonParser.add_argument('-gs', '--governorSlots',
+                          help='Maximum of mutating WSAPI calls in flight per array from all processes, 0 disables',
+                          type=int, default=int(os.environ.get('WSAPI_MAX_INFLIGHT') or 0))
+commonParser.add_argument('-gp', '--governorPriority', help='Priority class of WSAPI calls, by task by default',
+                          choices=['high', 'normal', 'low'])
+
+# CPG placement Parser
+placementParser = argparse.ArgumentParser(add_help=False)
+placementParser.add_argument('-cp', '--cpgPolicy', help='How to choose CPG from the list of candidate CPGs',
+                             choices=['spread', 'free', 'fill'], default='spread')
+placementParser.add_argument('-ct', '--cpgCacheTtl', help='Seconds to cache CPG stats used for placement', type=int,
+                             default=60)
 
 # MonitorCPG task parser
 monitorCPGParser = subparsers.add_parser('monitorCPG', parents=[commonParser], help='Get CPG Available Space')
-monitorCPGParser.add_argument('-c', '--cpg', help='CPG Name', required=True)
+monitorCPGParser.add_argument('-c', '--cpg', help='CPG Name or comma separated list of CPG Names', required=True)
 monitorCPGParser.add_argument('-d', '--disks', help='Return disks info', type=boolarg, default=False)
 monitorCPGParser.add_argument('-di', '--datastoreId', help='DS ID', type=int)
 monitorCPGParser.add_argument('-nt', '--namingType', help='Best practices Naming conventions <TYPE> part', default='dev')
 monitorCPGParser.add_argument('-lf', '--legacyFormat', help='Legacy format to support OpenNebula <5.12', type=boolarg, default=False)
+monitorCPGParser.add_argument('-e', '--exporter', help='URL of exportMetrics task to read capacity from instead of array',
+                              default='')
+
+# ExportMetrics task parser
+exportMetricsParser = subparsers.add_parser('exportMetrics', parents=[commonParser],
+                                            help='Serve CPG and VV capacity from periodically refreshed snapshot over HTTP')
+exportMetricsParser.add_argument('-c', '--cpg', help='Comma separated list of CPG Names', required=True)
+exportMetricsParser.add_argument('-l', '--listen', help='Address and port to listen on', default='127.0.0.1:9633')
+exportMetricsParser.add_argument('-ri', '--refreshInterval', help='Seconds between refreshes from array', type=int,
+                                 default=60)
 
 # CreateVV task parser
-createVVParser = subparsers.add_parser('createVV', parents=[commonParser], help='Create new VV')
+createVVParser = subparsers.add_parser('createVV', parents=[commonParser, placementParser], help='Create new VV')
 createVVParser.add_argument('-nt', '--namingType', help='Best practices Naming conventions <TYPE> part', default='dev')
 createVVParser.add_argument('-id', '--id', help='ID of VV to use in VV name', required=True)
 createVVParser.add_argument('-sz', '--size', help='Size of VV in MiB', type=int, required=True)
 createVVParser.add_argument('-tpvv', '--tpvv', help='Thin provision', type=boolarg, default=True)
 createVVParser.add_argument('-tdvv', '--tdvv', help='Thin provision with deduplication', type=boolarg, default=False)
 createVVParser.add_argument('-compr', '--compression', help='Thin provision compressed volume', type=boolarg, default=False)
-createVVParser.add_argument('-c', '--cpg', help='CPG Name', required=True)
+createVVParser.add_argument('-c', '--cpg', help='CPG Name or comma separated list of candidate CPG Names', required=True)
 createVVParser.add_argument('-co', '--comment', help='Comment')
 
 # getVV task parser
@@ -76,7 +99,7 @@ deleteVVParser.add_argument('-nt', '--namingType', help='Best practices Naming c
 deleteVVParser.add_argument('-id', '--id', help='ID of VV to use in VV name', required=True)
 
 # CloneVV task parser
-cloneVVParser = subparsers.add_parser('cloneVV', parents=[commonParser], help='Clone specific VV to new one')
+cloneVVParser = subparsers.add_parser('cloneVV', parents=[commonParser, placementParser], help='Clone specific VV to new one')
 cloneVVParser.add_argument('-snt', '--srcNamingType', help='Source: Best practices Naming conventions <TYPE> part',
                            default='dev')
 cloneVVParser.add_argument('-sid', '--srcId', help='ID of source VV to use in VV name', required=True)
@@ -84,13 +107,46 @@ cloneVVParser.add_argument('-nt', '--namingType', help='Destination: Best practi
                            default='dev')
 cloneVVParser.add_argument('-id', '--id', help='ID of destination VV to use in VV name', required=True)
 cloneVVParser.add_argument('-sz', '--size', help='Size of destination VV in MiB', type=int, required=True)
-cloneVVParser.add_argument('-c', '--cpg', help='Destination VV CPG Name', required=True)
+cloneVVParser.add_argument('-c', '--cpg', help='Destination VV CPG Name or comma separated list of candidate CPG Names',
+                           required=True)
 cloneVVParser.add_argument('-tpvv', '--tpvv', help='Destination VV thin provision', type=boolarg, default=True)
 cloneVVParser.add_argument('-tdvv', '--tdvv', help='Destination VV thin provision with deduplication', type=boolarg,
                            default=False)
 cloneVVParser.add_argument('-compr', '--compression', help='Thin provision compressed volume', type=boolarg, default=False)
 cloneVVParser.add_argument('-co', '--comment', help='Comment')
 
+# FindImageByHash task parser
+findImageByHashParser = subparsers.add_parser('findImageByHash', parents=[commonParser],
+                                              help='Find image VV with the same content in image hash index')
+findImageByHashParser.add_argument('-md5', '--md5', help='MD5 of source image', default='')
+findImageByHashParser.add_argument('-sha1', '--sha1', help='SHA1 of source image', default='')
+findImageByHashParser.add_argument('-nd', '--noDecompress', help='Source image is imported without decompression',
+                                   type=boolarg, default=False)
+findImageByHashParser.add_argument('-cm', '--contentMatch', help='Source image data are written to VV unchanged, so SHA1 '
+                                   'can match SHA1 of data of other images', type=boolarg, default=False)
+findImageByHashParser.add_argument('-w', '--workers', help='Number of parallel WSAPI calls when index is rebuilt',
+                                   type=int, default=4)
+
+# SetImageHash task parser
+setImageHashParser = subparsers.add_parser('setImageHash', parents=[commonParser],
+                                           help='Record hashes of image in VV metadata and image hash index')
+setImageHashParser.add_argument('-n', '--name', help='Name of image VV', required=True)
+setImageHashParser.add_argument('-md5', '--md5', help='MD5 of source image', default='')
+setImageHashParser.add_argument('-sha1', '--sha1', help='SHA1 of source image', default='')
+setImageHashParser.add_argument('-csha1', '--contentSha1', help='SHA1 of image data written to VV', default='')
+setImageHashParser.add_argument('-nd', '--noDecompress', help='Source image was imported without decompression',
+                                type=boolarg, default=False)
+
+# ClearImageHash task parser
+clearImageHashParser = subparsers.add_parser('clearImageHash', parents=[commonParser],
+                                             help='Remove hashes of image which data are going to change')
+clearImageHashParser.add_argument('-n', '--name', help='Name of image VV', required=True)
+
+# RebuildImageIndex task parser
+rebuildImageIndexParser = subparsers.add_parser('rebuildImageIndex', parents=[commonParser],
+                                                help='Rebuild image hash index from VV metadata')
+rebuildImageIndexParser.add_argument('-w', '--workers', help='Number of parallel WSAPI calls', type=int, default=4)
+
 # CopyVV task parser
 copyVVParser = subparsers.add_parser('copyVV', parents=[commonParser], help='Copy specific VV to another one')
 copyVVParser.add_argument('-nt', '--namingType', help='Source: Best practices Naming conventions <TYPE> part',
@@ -107,6 +163,13 @@ growVVParser = subparsers.add_parser('growVV', parents=[commonParser], help='Gro
 growVVParser.add_argument('-n', '--name', help='Name of VV to grow', required=True)
 growVVParser.add_argument('-gb', '--growBy', help='Grow by in MiB', type=int, required=True)
 
+# ResizeVV task parser
+resizeVVParser = subparsers.add_parser('resizeVV', parents=[commonParser],
+                                       help='Grow VV to specific size and list all its exports')
+resizeVVParser.add_argument('-n', '--name', help='Name of VV to resize', required=True)
+resizeVVParser.add_argument('-sz', '--size', help='New size of VV in MiB', type=int, required=True)
+resizeVVParser.add_argument('-hs', '--host', help='Export VV to this host if it is not exported yet')
+
 # getVVSize task parser
 getVVSizeParser = subparsers.add_parser('getVVSize', parents=[commonParser], help='Get size of VV')
 getVVSizeParser.add_argument('-n', '--name', help='Name of VV', required=True)
@@ -124,7 +187,7 @@ unexportVVParser.add_argument('-n', '--name', help='Name of VV to unexport', req
 unexportVVParser.add_argument('-hs', '--host', help='Name of host to unexport from', required=True)
 
 # CreateVmClone task parser
-createVmCloneParser = subparsers.add_parser('createVmClone', parents=[commonParser],
+createVmCloneParser = subparsers.add_parser('createVmClone', parents=[commonParser, placementParser],
                                             help='Create VM Clone VV based on source VV')
 createVmCloneParser.add_argument('-sn', '--srcName', help='Name of source VV to copy to VM disk', required=True)
 createVmCloneParser.add_argument('-nt', '--namingType', help='Best practices Naming conventions <TYPE> part',
@@ -132,23 +195,29 @@ createVmCloneParser.add_argument('-nt', '--namingType', help='Best practices Nam
 createVmCloneParser.add_argument('-id', '--id', help='ID of VM disk', required=True)
 createVmCloneParser.add_argument('-vi', '--vmId', help='Id of VM', required=True)
 createVmCloneParser.add_argument('-sz', '--size', help='Size of destination VV in MiB', type=int, required=True)
-createVmCloneParser.add_argument('-c', '--cpg', help='Destination VV CPG Name', required=True)
+createVmCloneParser.add_argument('-c', '--cpg', help='Destination VV CPG Name or comma separated list of candidate CPG Names',
+                                 required=True)
 createVmCloneParser.add_argument('-tpvv', '--tpvv', help='Thin provision', type=boolarg, default=True)
 createVmCloneParser.add_argument('-tdvv', '--tdvv', help='Thin provision with deduplication', type=boolarg, default=False)
 createVmCloneParser.add_argument('-compr', '--compression', help='Thin provision compressed volume', type=boolarg, default=False)
 createVmCloneParser.add_argument('-co', '--comment', help='Comment')
+createVmCloneParser.add_argument('-cm', '--cloneMode', help='Full copy or writable virtual copy promoted later by promoteVmClones task',
+                                 choices=['copy', 'virtual'], default='copy')
 
 # CreateVmVV task parser
-createVmVVParser = subparsers.add_parser('createVmVV', parents=[commonParser], help='Create new VM VV')
+createVmVVParser = subparsers.add_parser('createVmVV', parents=[commonParser, placementParser], help='Create new VM VV')
 createVmVVParser.add_argument('-nt', '--namingType', help='Best practices Naming conventions <TYPE> part', default='dev')
 createVmVVParser.add_argument('-id', '--id', help='ID of VM disk', required=True)
 createVmVVParser.add_argument('-vi', '--vmId', help='Id of VM', required=True)
 createVmVVParser.add_argument('-sz', '--size', help='Size of destination VV in MiB', type=int, required=True)
-createVmVVParser.add_argument('-c', '--cpg', help='Destination VV CPG Name', required=True)
+createVmVVParser.add_argument('-c', '--cpg', help='Destination VV CPG Name or comma separated list of candidate CPG Names',
+                              required=True)
 createVmVVParser.add_argument('-tpvv', '--tpvv', help='Thin provision', type=boolarg, default=True)
 createVmVVParser.add_argument('-tdvv', '--tdvv', help='Thin provision with deduplication', type=boolarg, default=False)
 createVmVVParser.add_argument('-compr', '--compression', help='Thin provision compressed volume', type=boolarg, default=False)
 createVmVVParser.add_argument('-co', '--comment', help='Comment')
+createVmVVParser.add_argument('-pl', '--pool', help='Claim pre-created VV from pool filled by fillVVPool task', type=boolarg,
+                              default=False)
 
 # GetVmClone task parser
 getVmCloneParser = subparsers.add_parser('getVmClone', parents=[commonParser], help='Get VM Clone VV name and wwn')
@@ -157,6 +226,16 @@ getVmCloneParser.add_argument('-nt', '--namingType', help='Best practices Naming
 getVmCloneParser.add_argument('-id', '--id', help='ID of VM disk', required=True)
 getVmCloneParser.add_argument('-vi', '--vmId', help='Id of VM', required=True)
 
+# DescribeVm task parser
+describeVmParser = subparsers.add_parser('describeVm', parents=[commonParser],
+                                         help='Get name, wwn, sizes and exports of VM disks in one call')
+describeVmParser.add_argument('-nt', '--namingType', help='Best practices Naming conventions <TYPE> part',
+                              default='dev')
+describeVmParser.add_argument('-vi', '--vmId', help='Id of VM', required=True)
+describeVmParser.add_argument('-id', '--ids', help='Comma separated list of VM disk IDs, <ID>:<VV name> for persistent '
+                                                   'images, all VV set members by default', default='')
+describeVmParser.add_argument('-hs', '--host', help='Also check if host with this name is registered')
+
 # DeleteVmClone task parser
 deleteVmCloneParser = subparsers.add_parser('deleteVmClone', parents=[commonParser], help='Delete VM Clone VV')
 deleteVmCloneParser.add_argument('-nt', '--namingType', help='Best practices Naming conventions <TYPE> part',
@@ -188,6 +267,17 @@ deleteVVSetSnapshotParser.add_argument('-nt', '--namingType', help='Source: Best
 deleteVVSetSnapshotParser.add_argument('-vi', '--vmId', help='Id of VM')
 deleteVVSetSnapshotParser.add_argument('-si', '--snapId', help='ID of snapshot', required=True)
 
+# RevertVVSetSnapshot task parser
+revertVVSetSnapshotParser = subparsers.add_parser('revertVVSetSnapshot', parents=[commonParser],
+                                                  help='Revert volume set snapshot to all member VVs at once')
+revertVVSetSnapshotParser.add_argument('-nt', '--namingType', help='Source: Best practices Naming conventions <TYPE> part',
+                                  default='dev')
+revertVVSetSnapshotParser.add_argument('-vi', '--vmId', help='Id of VM', required=True)
+revertVVSetSnapshotParser.add_argument('-si', '--snapId', help='ID of snapshot', required=True)
+revertVVSetSnapshotParser.add_argument('-o', '--online', help='Revert snapshot while VVs are online (exported)',
+                                       type=boolarg, default=False)
+revertVVSetSnapshotParser.add_argument('-w', '--workers', help='Number of parallel promotions', type=int, default=8)
+
 # CreateSnapshot task parser
 createSnapshotParser = subparsers.add_parser('createSnapshot', parents=[commonParser], help='Create snapshot of VV')
 createSnapshotParser.add_argument('-nt', '--namingType', help='Source: Best practices Naming conventions <TYPE> part',
@@ -245,6 +335,11 @@ getIscsiPortalsParser = subparsers.add_parser('getIscsiPortals', parents=[common
                                    help='Get list of iSCSI portals')
 getIscsiPortalsParser.add_argument('-sr', '--sort', help='Sort the portals by hierarchy and usage count', required=False,
                                                   type=boolarg, default=False)
+getIscsiPortalsParser.add_argument('-sm', '--sortMode', help='Rank ports by host paths count or by measured load',
+                                   choices=['count', 'load'], default='count')
+getIscsiPortalsParser.add_argument('-dc', '--decay', help='Weight of new port stats sample in moving average',
+                                   type=float, default=0.5)
+getIscsiPortalsParser.add_argument('-ct', '--cacheTtl', help='Seconds to cache port stats', type=int, default=60)
 
 # AddVolumeToVVSet task parser
 addVolumeToVVSetParser = subparsers.add_parser('addVolumeToVVSet', parents=[commonParser],
@@ -286,32 +381,150 @@ deleteQosPolicyParser.add_argument('-nt', '--namingType', help='Best practices N
 deleteQosPolicyParser.add_argument('-vi', '--vmId', help='Id of VM', required=True)
 deleteQosPolicyParser.add_argument('-n', '--name', help='Name of VV', required=True)
 
+# ReconcileQosPolicies task parser
+reconcileQosPoliciesParser = subparsers.add_parser('reconcileQosPolicies', parents=[commonParser],
+                                                   help='Reconcile QoS policies of all VM VV sets with desired rules')
+reconcileQosPoliciesParser.add_argument('-nt', '--namingType', help='Best practices Naming conventions <TYPE> part',
+                                        default='dev')
+reconcileQosPoliciesParser.add_argument('-vi', '--vmIds', help='Comma separated list of VM IDs, all VM VV sets by default',
+                                        default='')
+reconcileQosPoliciesParser.add_argument('-qp', '--qosPriority', help='QoS Priority', choices=['LOW', 'NORMAL', 'HIGH'],
+                                        required=True)
+reconcileQosPoliciesParser.add_argument('-qxi', '--qosMaxIops', help='QoS Max IOPS', type=int, required=True)
+reconcileQosPoliciesParser.add_argument('-qmi', '--qosMinIops', help='QoS Min IOPS', type=int, required=True)
+reconcileQosPoliciesParser.add_argument('-qxb', '--qosMaxBw', help='QoS Max BW in kB/s', type=int, required=True)
+reconcileQosPoliciesParser.add_argument('-qmb', '--qosMinBw', help='QoS Min BW in kB/s', type=int, required=True)
+reconcileQosPoliciesParser.add_argument('-ql', '--qosLatency', help='QoS Latency in ms', type=int, required=True)
+reconcileQosPoliciesParser.add_argument('-cr', '--create', help='Create QoS policy for VM VV sets without one',
+                                        type=boolarg, default=False)
+reconcileQosPoliciesParser.add_argument('-w', '--workers', help='Number of parallel WSAPI calls', type=int, default=4)
+reconcileQosPoliciesParser.add_argument('-dr', '--dryRun', help='Only print changes, do not apply them', type=boolarg,
+                                        default=False)
+
+# FillVVPool task parser
+fillVVPoolParser = subparsers.add_parser('fillVVPool', parents=[commonParser, placementParser],
+                                         help='Top up pool of pre-created VVs claimed by createVmVV')
+fillVVPoolParser.add_argument('-nt', '--namingType', help='Best practices Naming conventions <TYPE> part', default='dev')
+fillVVPoolParser.add_argument('-ps', '--poolSizes', help='Comma separated list of <size in MiB>:<count> to keep in pool',
+                              required=True)
+fillVVPoolParser.add_argument('-c', '--cpg', help='CPG Name or comma separated list of candidate CPG Names', required=True)
+fillVVPoolParser.add_argument('-tpvv', '--tpvv', help='Thin provision', type=boolarg, default=True)
+fillVVPoolParser.add_argument('-tdvv', '--tdvv', help='Thin provision with deduplication', type=boolarg, default=False)
+fillVVPoolParser.add_argument('-compr', '--compression', help='Thin provision compressed volume', type=boolarg, default=False)
+fillVVPoolParser.add_argument('-w', '--workers', help='Number of parallel WSAPI calls', type=int, default=4)
+fillVVPoolParser.add_argument('-dr', '--dryRun', help='Only print changes, do not apply them', type=boolarg,
+                              default=False)
+
+# PromoteVmClones task parser
+promoteVmClonesParser = subparsers.add_parser('promoteVmClones', parents=[commonParser],
+                                              help='Promote virtual VM clones to independent VVs')
+promoteVmClonesParser.add_argument('-nt', '--namingType', help='Best practices Naming conventions <TYPE> part',
+                                   default='dev')
+promoteVmClonesParser.add_argument('-vi', '--vmIds', help='Comma separated list of VM IDs, all VMs by default',
+                                   default='')
+promoteVmClonesParser.add_argument('-w', '--workers', help='Number of parallel promotions', type=int, default=2)
+promoteVmClonesParser.add_argument('-dr', '--dryRun', help='Only print clones to promote, do not promote them',
+                                   type=boolarg, default=False)
+promoteVmClonesParser.add_argument('-l', '--live', help='Promote clones of running VMs by live block copy and pivot',
+                                   type=boolarg, default=False)
+
+# PromoteVmDisks task parser
+promoteVmDisksParser = subparsers.add_parser('promoteVmDisks', parents=[commonParser],
+                                             help='Promote virtual clones of VM disks before snapshot')
+promoteVmDisksParser.add_argument('-nt', '--namingType', help='Best practices Naming conventions <TYPE> part',
+                                  default='dev')
+promoteVmDisksParser.add_argument('-vi', '--vmId', help='VM ID', required=True)
+promoteVmDisksParser.add_argument('-id', '--id', help='Disk ID, all disks of VM by default')
+
+# ReclaimSpace task parser
+reclaimSpaceParser = subparsers.add_parser('reclaimSpace', parents=[commonParser],
+                                           help='Trim filesystems of running VMs through guest agent and report reclaimed space')
+reclaimSpaceParser.add_argument('-nt', '--namingType', help='Best practices Naming conventions <TYPE> part',
+                                default='dev')
+reclaimSpaceParser.add_argument('-di', '--datastoreId', help='Only VMs on this system DS', type=int)
+reclaimSpaceParser.add_argument('-vi', '--vmIds', help='Comma separated list of VM IDs, all running VMs by default',
+                                default='')
+reclaimSpaceParser.add_argument('-w', '--workers', help='Number of hosts trimmed in parallel', type=int, default=2)
+reclaimSpaceParser.add_argument('-in', '--interval', help='Seconds between trims of VMs on one host', type=int,
+                                default=30)
+reclaimSpaceParser.add_argument('-st', '--settleTime', help='Seconds to wait for array to reclaim space before measure',
+                                type=int, default=60)
+reclaimSpaceParser.add_argument('-dr', '--dryRun', help='Only print VMs to trim, do not trim them',
+                                type=boolarg, default=False)
+
+# ReconcileOrphans task parser
+reconcileOrphansParser = subparsers.add_parser('reconcileOrphans', parents=[commonParser],
+                                               help='Find and delete VVs, VLUNs, VV sets and hosts left by failed actions')
+reconcileOrphansParser.add_argument('-nt', '--namingType', help='Best practices Naming conventions <TYPE> part',
+                                    default='dev')
+reconcileOrphansParser.add_argument('-ma', '--minAge', help='Only VVs older than this number of hours are orphans',
+                                    type=int, default=24)
+reconcileOrphansParser.add_argument('-w', '--workers', help='Number of parallel deletes', type=int, default=4)
+reconcileOrphansParser.add_argument('-r', '--rate', help='Maximum of deletes started per second', type=float, default=5)
+reconcileOrphansParser.add_argument('-dr', '--dryRun', help='Only print orphans, do not delete them',
+                                    type=boolarg, default=True)
+
+# GovernorStats task parser
+governorStatsParser = subparsers.add_parser('governorStats', parents=[commonParser],
+                                            help='Show WSAPI governor slots and queue wait times')
+governorStatsParser.add_argument('-r', '--reset', help='Reset collected wait times', type=boolarg, default=False)
+
+# QosController task parser
+qosControllerParser = subparsers.add_parser('qosController', parents=[commonParser],
+                                            help='Adapt QoS max limits of VM VV sets to their live performance')
+qosControllerParser.add_argument('-nt', '--namingType', help='Best practices Naming conventions <TYPE> part',
+                                 default='dev')
+qosControllerParser.add_argument('-vi', '--vmIds', help='Comma separated list of VM IDs, all VM VV sets by default',
+                                 default='')
+qosControllerParser.add_argument('-fi', '--iopsFloor', help='Lowest QoS Max IOPS controller can set, at least 1',
+                                 type=int, default=1)
+qosControllerParser.add_argument('-ci', '--iopsCeiling', help='Highest QoS Max IOPS controller can set, 0 disables IOPS control',
+                                 type=int, default=0)
+qosControllerParser.add_argument('-fb', '--bwFloor', help='Lowest QoS Max BW in kB/s controller can set, at least 1',
+                                 type=int, default=1)
+qosControllerParser.add_argument('-cb', '--bwCeiling', help='Highest QoS Max BW in kB/s controller can set, 0 disables BW control',
+                                 type=int, default=0)
+qosControllerParser.add_argument('-hw', '--highWatermark', help='Usage/limit ratio to widen the limit', type=float, default=0.9)
+qosControllerParser.add_argument('-lw', '--lowWatermark', help='Usage/limit ratio to tighten the limit', type=float, default=0.3)
+qosControllerParser.add_argument('-st', '--step', help='Relative change of the limit in one step', type=float, default=0.25)
+qosControllerParser.add_argument('-sm', '--samples', help='Number of consecutive samples needed to change the limit',
+                                 type=int, default=3)
+qosControllerParser.add_argument('-ml', '--maxLatency', help='Do not widen limits of VV sets with higher latency in ms, 0 disables',
+                                 type=float, default=0)
+qosControllerParser.add_argument('-in', '--interval', help='Seconds between samples', type=int, default=300)
+qosControllerParser.add_argument('-it', '--iterations', help='Number of samples to take, 0 means forever', type=int, default=0)
+qosControllerParser.add_argument('-rc', '--record', help='Append sampled stats and rules to this file')
+qosControllerParser.add_argument('-rp', '--replay', help='Replay stats recorded by --record offline, implies dry run')
+qosControllerParser.add_argument('-dr', '--dryRun', help='Only print changes, do not apply them', type=boolarg,
+                                 default=False)
+
 # ------------
 # Define tasks
 # ------------
 def monitorCPG(cl, args):
-    cpgName = args.cpg
-    cpgData = cl.getCPG(cpgName)
-    cpgAvailableSpace = cl.getCPGAvailableSpace(cpgName)
+    cpgNames = args.cpg.split(',')
 
-    used = cpgData.get('UsrUsage').get('usedMiB')
-    free = cpgAvailableSpace.get('usableFreeMiB')
-    total = used + free
+    if args.exporter:
+        snapshot = getExporterSnapshot(args.exporter, args.api, cpgNames)
+        if snapshot is None:
+            # exporter is down or stale, monitoring must not stop with it, read array directly
+            cl.login(args.username, args.password)
+            try:
+                snapshot = getCapacitySnapshot(cl, cpgNames, args.disks)
+            finally:
+                cl.logout()
+    else:
+        snapshot = getCapacitySnapshot(cl, cpgNames, args.disks)
 
-    print('USED_MB={used}'.format(used=used))
-    print('TOTAL_MB={total}'.format(total=total))
-    print('FREE_MB={free}'.format(free=free))
+    # report aggregate of all CPGs
+    printCPGCapacity(snapshot, cpgNames)
 
     if args.disks == True:
       import subprocess
       import xmltodict
       from base64 import b64encode
       
-      vvs = cl.getVolumes()
-      diskSizes = {}
-
-      for vv in vvs.get('members'):
-        diskSizes[vv.get('name')] = vv.get('userSpace').get('usedMiB')
+      diskSizes = dict((name, sizes[0]) for name, sizes in snapshot.get('vvs').items())
       
       vmsXml = subprocess.check_output('onevm list --extended -x', shell=True)
       vms = xmltodict.parse(vmsXml, force_list=('VM',))
@@ -334,11 +547,7 @@ def monitorCPG(cl, args):
 
         diskResult = []
         for disk in disks:
-          if disk.get('CLONE') == 'YES' or disk.get('SOURCE') is None or disk.get('SOURCE') == '':
-            name = '{namingType}.vm.{vmId}.{diskId}'.format(namingType=args.namingType, vmId=vm.get('ID'), diskId=disk.get('DISK_ID'))
-          else:
-            source = disk.get('SOURCE').split(':')
-            name = source[0]
+          name = createVmDiskVVName(args.namingType, vm.get('ID'), disk)
           if name in diskSizes:
             diskResult.append('DISK_SIZE=[ID={diskId},SIZE={diskSize}]'.format(diskId=disk.get('DISK_ID'), diskSize=diskSizes[name]))
        
@@ -347,6 +556,69 @@ def monitorCPG(cl, args):
         else:
             print(result + b64encode(' '.join(diskResult).encode('ascii')).decode('ascii') + '"]')
 
+def exportMetrics(cl, args):
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+    from urllib.parse import urlsplit, parse_qs
+    import json
+    import threading
+
+    cpgNames = args.cpg.split(',')
+    state = {'snapshot': None, 'duration': 0.0, 'refreshes': 0, 'errors': 0}
+
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, format, *args):
+            pass
+
+        def reply(self, status, contentType, text):
+            data = text.encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', contentType)
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_GET(self):
+            url = urlsplit(self.path)
+            snapshot = state['snapshot']
+            if url.path == '/metrics':
+                return self.reply(200, 'text/plain; version=0.0.4', formatMetrics(snapshot, state))
+
+            # consumers must not get stale capacity
+            if snapshot is None or time.time() - snapshot.get('time') > 3 * args.refreshInterval:
+                return self.reply(503, 'text/plain', 'No recent snapshot of array\n')
+
+            if url.path == '/snapshot':
+                self.reply(200, 'application/json', json.dumps(snapshot))
+            elif url.path == '/monitorCPG':
+                names = parse_qs(url.query).get('cpg', [args.cpg])[0].split(',')
+                if not all(cpgName in snapshot.get('cpgs') for cpgName in names):
+                    return self.reply(404, 'text/plain', 'CPG is not exported\n')
+                used, free = sumCPGCapacity(snapshot, names)
+                self.reply(200, 'text/plain', 'USED_MB={used}\nTOTAL_MB={total}\nFREE_MB={free}\n'.format(
+                    used=used, total=used + free, free=free))
+            else:
+                self.reply(404, 'text/plain', 'Not found\n')
+
+    host, port = args.listen.rsplit(':', 1)
+    server = ThreadingHTTPServer((host, int(port)), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    # one snapshot per interval no matter how many consumers read it
+    try:
+        while True:
+            start = time.time()
+            try:
+                state['snapshot'] = getCapacitySnapshot(cl, cpgNames, True)
+                state['refreshes'] += 1
+            except Exception as ex:
+                state['errors'] += 1
+                print('Refresh failed: {ex}'.format(ex=ex))
+            state['duration'] = time.time() - start
+            time.sleep(max(0, args.refreshInterval - state['duration']))
+    except KeyboardInterrupt:
+        server.shutdown()
+
 def createVV(cl, args):
     name = createVVName(args.namingType, args.id)
 
@@ -378,6 +650,113 @@ def cloneVV(cl, args):
     wwn = vv.get('wwn').lower()
     print('{name}:{wwn}'.format(name=destName, wwn=wwn))
 
+def findImageByHash(cl, args):
+    index = loadCache(cl, 'images')
+    if index is None:
+        # index in temp dir is lost on reboot, lookup must not miss imported images
+        names, index = buildImageIndex(cl, args.workers)
+        updateCache(cl, 'images', lambda data: index)
+    else:
+        index = index.get('data')
+
+    keys = [('sha1', args.sha1), ('md5', args.md5)]
+    # plain raw file has the same SHA1 as the data streamed from it
+    if args.contentMatch:
+        keys.append(('contentSha1', args.sha1))
+
+    for key, value in keys:
+        name = index.get('{key}:{value}'.format(key=key, value=value.lower())) if value else None
+        if name is None:
+            continue
+        # index can be stale, VV metadata is the source of truth
+        try:
+            meta = dict((data.get('key'), data.get('value')) for data in cl.getAllVolumeMetaData(name).get('members'))
+        except exceptions.HTTPNotFound:
+            meta = {}
+
+        if meta.get(key) == value.lower():
+            # the same source imported with other decompression setting has other data
+            if key != 'contentSha1' and (meta.get('noDecompress') == 'YES') != args.noDecompress:
+                continue
+            # image which is or was persistent can be changed by VM
+            if isImagePersistent(name):
+                clearImageHashWithName(cl, name)
+                continue
+            vv = cl.getVolume(name)
+            print('{name}:{wwn}'.format(name=name, wwn=vv.get('wwn').lower()))
+            return
+
+        def forget(data):
+            data.pop('{key}:{value}'.format(key=key, value=value.lower()), None)
+            return data
+
+        updateCache(cl, 'images', forget)
+
+def isImagePersistent(name):
+    import subprocess
+    import xmltodict
+
+    # image VVs are named <TYPE>.<ID>, unknown image is not safe to copy either
+    try:
+        imageXml = subprocess.check_output(['oneimage', 'show', '-x', name.split('.')[1]], stderr=subprocess.STDOUT)
+    except subprocess.CalledProcessError:
+        return True
+    return xmltodict.parse(imageXml).get('IMAGE').get('PERSISTENT') != '0'
+
+def setImageHash(cl, args):
+    hashes = {}
+    for key, value in [('md5', args.md5), ('sha1', args.sha1), ('contentSha1', args.contentSha1)]:
+        if value:
+            hashes[key] = value.lower()
+            cl.setVolumeMetaData(args.name, key, value.lower())
+    cl.setVolumeMetaData(args.name, 'noDecompress', 'YES' if args.noDecompress else 'NO')
+
+    def add(data):
+        for key, value in hashes.items():
+            data['{key}:{value}'.format(key=key, value=value)] = args.name
+        return data
+
+    updateCache(cl, 'images', add)
+
+def clearImageHash(cl, args):
+    clearImageHashWithName(cl, args.name)
+
+def clearImageHashWithName(cl, name):
+    for key in ['md5', 'sha1', 'contentSha1', 'noDecompress']:
+        try:
+            cl.removeVolumeMetaData(name, key)
+        except exceptions.HTTPNotFound:
+            pass
+
+    def forget(data):
+        return dict((key, value) for key, value in data.items() if value != name)
+
+    updateCache(cl, 'images', forget)
+
+def rebuildImageIndex(cl, args):
+    names, index = buildImageIndex(cl, args.workers)
+    updateCache(cl, 'images', lambda data: index)
+    print('IMAGES={images} HASHES={hashes}'.format(images=len(names), hashes=len(index)))
+
+def buildImageIndex(cl, workers):
+    # image VVs are named <TYPE>.<ID>
+    names = []
+    for vv in cl.getVolumes().get('members', []):
+        parts = vv.get('name').split('.')
+        if len(parts) == 2 and parts[1].isdigit() and vv.get('copyType') != cl.VIRTUAL_COPY:
+            names.append(vv.get('name'))
+
+    index = {}
+    for name, meta, ex in runParallel(lambda x: cl.getAllVolumeMetaData(x), names, workers):
+        if ex is not None:
+            print('FAILED {name}: {ex}'.format(name=name, ex=ex))
+            continue
+        for data in meta.get('members', []):
+            if data.get('key') in ['md5', 'sha1', 'contentSha1']:
+                index['{key}:{value}'.format(key=data.get('key'), value=data.get('value'))] = name
+
+    return names, index
+
 def copyVV(cl, args):
   snapId = args.snapId
 
@@ -394,8 +773,43 @@ def copyVV(cl, args):
   cl.copyVolume(srcName, args.destName, args.cpg, optional)
 
 def growVV(cl, args):
+    # virtual copy can not grow
+    status = promoteVirtualClone(cl, args.name, live=True)
+    if status not in ['PROMOTED', 'NOT_VIRTUAL']:
+        print('Virtual clone {name} can not be resized until promoted: {status}'.format(name=args.name, status=status))
+        cl.logout()
+        exit(1)
+
     cl.growVolume(args.name, args.growBy)
 
+def resizeVV(cl, args):
+    from urllib.parse import quote
+
+    vv = cl.getVolume(args.name)
+    if args.size > vv.get('sizeMiB'):
+        args.growBy = args.size - vv.get('sizeMiB')
+        growVV(cl, args)
+        # promotion of virtual clone changes WWN
+        vv = cl.getVolume(args.name)
+
+    print('NAME={name} WWN={wwn} VSIZE={vsize}'.format(name=args.name, wwn=vv.get('wwn').lower(),
+                                                      vsize=max(args.size, vv.get('sizeMiB'))))
+
+    # all hosts which have to see new size
+    query = '"volumeName EQ {name}"'.format(name=args.name)
+    response, body = cl.http.get('/vluns?query={query}'.format(query=quote(query.encode('utf8'))))
+    luns = {}
+    for vlun in body.get('members', []):
+        if vlun.get('hostname'):
+            luns[vlun.get('hostname')] = vlun.get('lun')
+
+    if args.host and args.host not in luns:
+        location = cl.createVLUN(args.name, None, args.host, None, None, None, True)
+        luns[args.host] = location.split(',')[1]
+
+    for host, lun in sorted(luns.items()):
+        print('HOST={host} LUN={lun}'.format(host=host, lun=lun))
+
 def getVVSize(cl, args):
     vv = cl.getVolume(args.name)
 
@@ -459,6 +873,13 @@ def unexportVV(cl, args):
 def createVmClone(cl, args):
     destName = createVmCloneName(args.namingType, args.id, args.vmId)
 
+    # writable virtual copy is instant, it can not be bigger than source
+    if args.cloneMode == 'virtual' and max(args.size, 256) <= cl.getVolume(args.srcName).get('sizeMiB'):
+        vv = createVirtualClone(cl, destName, args)
+        wwn = vv.get('wwn').lower()
+        print('{name}:{wwn}'.format(name=destName, wwn=wwn))
+        return
+
     # create new VV
     vv = createVVWithName(cl, destName, args)
 
@@ -489,8 +910,13 @@ def createVmClone(cl, args):
 def createVmVV(cl, args):
     name = createVmCloneName(args.namingType, args.id, args.vmId)
 
-    # create new VV
-    vv = createVVWithName(cl, name, args)
+    # claim pre-created VV or create new one
+    vv = None
+    if args.pool:
+        vv = claimPoolVV(cl, name, args)
+        countPoolClaim(cl, vv is not None)
+    if vv is None:
+        vv = createVVWithName(cl, name, args)
 
     # print info
     wwn = vv.get('wwn').lower()
@@ -502,6 +928,69 @@ def getVmClone(cl, args):
     wwn = vv.get('wwn').lower()
     print('{name}:{wwn}'.format(name=name, wwn=wwn))
 
+def describeVm(cl, args):
+    from urllib.parse import quote
+
+    vvsetName = '{namingType}.vm.{vmId}'.format(namingType=args.namingType, vmId=args.vmId)
+    try:
+        members = cl.getVolumeSet(vvsetName).get('setmembers') or []
+    except exceptions.HTTPNotFound:
+        members = []
+
+    # disk id and VV name pairs
+    disks = []
+    if args.ids == '':
+        for member in members:
+            parts = member.split('.')
+            disks.append((parts[-1] if member.startswith(vvsetName + '.') else member, member))
+    else:
+        for diskId in args.ids.split(','):
+            if ':' in diskId:
+                disks.append(tuple(diskId.split(':', 1)))
+            else:
+                disks.append((diskId, createVmCloneName(args.namingType, diskId, args.vmId)))
+
+    if args.host:
+        try:
+            cl.getHost(args.host)
+            print('HOST={host} EXISTS=YES'.format(host=args.host))
+        except exceptions.HTTPNotFound:
+            print('HOST={host} EXISTS=NO'.format(host=args.host))
+
+    if not disks:
+        return
+
+    # all volumes and their exports in two requests
+    names = [name for diskId, name in disks]
+    query = '"{query}"'.format(query=' OR '.join('name EQ {name}'.format(name=name) for name in names))
+    response, body = cl.http.get('/volumes?query={query}'.format(query=quote(query.encode('utf8'))))
+    vvs = dict((vv.get('name'), vv) for vv in body.get('members', []))
+
+    query = '"{query}"'.format(query=' OR '.join('volumeName EQ {name}'.format(name=name) for name in names))
+    response, body = cl.http.get('/vluns?query={query}'.format(query=quote(query.encode('utf8'))))
+    exports = {}
+    for vlun in body.get('members', []):
+        hosts = exports.setdefault(vlun.get('volumeName'), [])
+        if vlun.get('hostname') and vlun.get('hostname') not in hosts:
+            hosts.append(vlun.get('hostname'))
+
+    for diskId, name in disks:
+        vv = vvs.get(name)
+        if vv is None:
+            print('DISK_ID={id} NAME={name} EXISTS=NO'.format(id=diskId, name=name))
+            continue
+        print('DISK_ID={id} NAME={name} EXISTS=YES WWN={wwn} VSIZE={vsize} USED={used} SNAP={snap} VIRTUAL={virtual} '
+              'VVSET={vvset} EXPORTED={exported}'.format(
+                id=diskId,
+                name=name,
+                wwn=vv.get('wwn').lower(),
+                vsize=vv.get('sizeMiB'),
+                used=vv.get('userSpace', {}).get('usedMiB'),
+                snap=vv.get('snapshotSpace', {}).get('usedMiB'),
+                virtual='YES' if vv.get('copyType') == cl.VIRTUAL_COPY else 'NO',
+                vvset='YES' if name in members else 'NO',
+                exported=','.join(exports.get(name, []))))
+
 def deleteVmClone(cl, args):
     name = createVmCloneName(args.namingType, args.id, args.vmId)
 
@@ -512,6 +1001,14 @@ def mvVmClone(cl, args):
     dstName = createVmCloneName(args.namingType, args.id, args.vmId)
 
     cl.modifyVolume(srcName, {'newName': dstName})
+
+    # source of virtual clone tracks its name
+    try:
+        cloneOf = cl.getVolumeMetaData(dstName, 'cloneOf').get('value')
+        cl.setVolumeMetaData(cloneOf, createVirtualCloneMetaKey(dstName), dstName)
+    except exceptions.HTTPNotFound:
+        pass
+
     print('{name}'.format(name=dstName))
 
 
@@ -589,6 +1086,56 @@ def deleteVVSetSnapshot(cl, args):
             pass
 
 
+def revertVVSetSnapshot(cl, args):
+    snapId = 's{snapId}'.format(snapId=args.snapId)
+    vvsetName = '{namingType}.vm.{vmId}'.format(namingType=args.namingType, vmId=args.vmId)
+
+    # get volume set info
+    try:
+        vvset = cl.getVolumeSet(vvsetName)
+        members = vvset.get('setmembers')
+    except exceptions.HTTPNotFound:
+        print('Volume set {name} does not exist, nothing to revert'.format(name=vvsetName))
+        cl.logout()
+        exit(1)
+
+    # no members in volume set? unexpected
+    if not members or not len(members) > 0:
+        print('Volume set {name} has no members, nothing to revert'.format(name=vvsetName))
+        cl.logout()
+        exit(1)
+
+    def revert(member):
+        snapName, metaKey = createSnapshotNameAndMetaKey(member, snapId)
+
+        # disks attached after snapshot was taken have nothing to revert
+        try:
+            cl.getVolumeMetaData(member, metaKey)
+        except exceptions.HTTPNotFound:
+            return None
+
+        start = time.time()
+        task = cl.promoteVirtualCopy(snapName, {'online': args.online})
+        if task and task.get('taskid'):
+            # fine polling, so TOOK is not rounded to poll interval
+            waitForTask(cl, task.get('taskid'), 0.5)
+        return time.time() - start
+
+    # promote all members at once and wait for them together
+    failed = 0
+    for member, took, ex in runParallel(revert, members, args.workers):
+        if ex is not None:
+            failed += 1
+            print('FAILED {name}: {ex}'.format(name=member, ex=ex))
+        elif took is None:
+            print('SKIPPED {name}'.format(name=member))
+        else:
+            print('REVERTED {name} TOOK={took:.1f}s'.format(name=member, took=took))
+
+    if failed:
+        cl.logout()
+        exit(1)
+
 
 def createSnapshot(cl, args):
     snapId = args.snapId
@@ -623,6 +1170,10 @@ def revertSnapshot(cl, args):
 
     name, metaKey = createSnapshotNameAndMetaKey(srcName, snapId)
 
+    # image data change, it can not be used as copy source of the same image anymore
+    if args.vmClone != True:
+        clearImageHashWithName(cl, srcName)
+
     optional = {'online': args.online}
 
     cl.promoteVirtualCopy(name, optional)
@@ -655,6 +1206,9 @@ def flattenSnapshot(cl, args):
 
     name, metaKey = createSnapshotNameAndMetaKey(srcName, snapId)
 
+    # image data change, it can not be used as copy source of the same image anymore
+    clearImageHashWithName(cl, srcName)
+
     # promote selected snapshot
     cl.promoteVirtualCopy(name)
 
@@ -745,8 +1299,18 @@ def getIscsiPortals(cl, args):
             if portName in portInfo:
                 portInfo[portName]['count'] += 1
 
-    # Sort ports by usage count
-    sortedPorts = [port for port in sorted(portInfo, key=lambda x: portInfo[x]['count'])]
+    if args.sortMode == 'load':
+        # Sort ports by measured load, usage count breaks ties
+        portLoad = getPortLoad(cl, args.decay, args.cacheTtl)
+        maxIops = max([portLoad.get(port, {}).get('iops', 0.0) for port in portInfo] + [1.0])
+        maxKbps = max([portLoad.get(port, {}).get('kbps', 0.0) for port in portInfo] + [1.0])
+        for port in portInfo:
+            load = portLoad.get(port, {})
+            portInfo[port]['load'] = load.get('iops', 0.0) / maxIops + load.get('kbps', 0.0) / maxKbps
+        sortedPorts = [port for port in sorted(portInfo, key=lambda x: (portInfo[x]['load'], portInfo[x]['count']))]
+    else:
+        # Sort ports by usage count
+        sortedPorts = [port for port in sorted(portInfo, key=lambda x: portInfo[x]['count'])]
 
     # Make tree of ports hierarchy: node --> slot --> ports
     # eg: {'1': {'2': ['1:2:1', '1:2:2']}, '0': {'2': ['0:2:1', '0:2:2']}}
@@ -776,7 +1340,11 @@ def addVolumeToVVSet(cl, args):
         cl.getVolumeSet(vvsetName)
     except exceptions.HTTPNotFound:
         print('Volume Set does not exists, create new')
-        cl.createVolumeSet(vvsetName, None, args.comment)
+        try:
+            cl.createVolumeSet(vvsetName, None, args.comment)
+        except exceptions.HTTPConflict:
+            # created meanwhile by parallel action for other disk of the VM
+            print('Volume Set already created')
 
     # add volume to vvset
     try:
@@ -821,17 +1389,17 @@ def createQosPolicy(cl, args):
     try:
         qos = cl.queryQoSRule(vvsetName)
         # compare rules
-        for k, v in qosRules.items():
-            if k == 'enable':
-                k = 'enabled'
-            if qos.get(k) != v:
-                # not match, update
-                print('QoS Policy Rules changed, need update')
-                cl.modifyQoSRules(vvsetName, qosRules)
-                break
+        if qosRulesChanged(qos, qosRules):
+            # not match, update
+            print('QoS Policy Rules changed, need update')
+            cl.modifyQoSRules(vvsetName, qosRules)
     except exceptions.HTTPNotFound:
         print('QoS Policy does not exists, create new')
-        cl.createQoSRules(vvsetName, qosRules)
+        try:
+            cl.createQoSRules(vvsetName, qosRules)
+        except exceptions.HTTPConflict:
+            # created meanwhile by parallel action for other disk of the VM, rules are the same
+            print('QoS Policy already created')
 
 
 def deleteQosPolicy(cl, args):
@@ -856,6 +1424,536 @@ def deleteQosPolicy(cl, args):
         print('QoS Policy already does not exits')
 
 
+def reconcileQosPolicies(cl, args):
+    vvsetPrefix = '{namingType}.vm.'.format(namingType=args.namingType)
+    vmIds = prepareVmIds(args)
+    qosRules = prepareQosRules(args)
+
+    # get all QoS rules and VV sets in one listing each
+    rules = {}
+    for qos in cl.queryQoSRules().get('members', []):
+        rules[qos.get('name')] = qos
+
+    changes = []
+    unchanged = 0
+    for vvset in cl.getVolumeSets().get('members', []):
+        vvsetName = vvset.get('name')
+        if not vvsetName.startswith(vvsetPrefix):
+            continue
+        if vmIds and vvsetName[len(vvsetPrefix):] not in vmIds:
+            continue
+
+        qos = rules.get(vvsetName)
+        if qos is None:
+            if args.create:
+                changes.append(('create', vvsetName))
+        elif qosRulesChanged(qos, qosRules):
+            changes.append(('modify', vvsetName))
+        else:
+            unchanged += 1
+
+    for action, vvsetName in changes:
+        print('{action} {name}'.format(action=action.upper(), name=vvsetName))
+
+    failed = []
+    if not args.dryRun:
+        def applyChange(change):
+            action, vvsetName = change
+            if action == 'create':
+                cl.createQoSRules(vvsetName, qosRules)
+            else:
+                cl.modifyQoSRules(vvsetName, qosRules)
+
+        for change, result, ex in runParallel(applyChange, changes, args.workers):
+            if ex is not None:
+                print('FAILED {name}: {ex}'.format(name=change[1], ex=ex))
+                failed.append(change)
+
+    print('DRY_RUN={dryRun} CREATE={create} MODIFY={modify} UNCHANGED={unchanged} FAILED={failed}'.format(
+        dryRun='YES' if args.dryRun else 'NO',
+        create=len([c for c in changes if c[0] == 'create']),
+        modify=len([c for c in changes if c[0] == 'modify']),
+        unchanged=unchanged,
+        failed=len(failed)))
+
+    if failed:
+        cl.logout()
+        exit(1)
+
+
+def fillVVPool(cl, args):
+    import copy
+
+    vvsetName = createPoolVVSetName(args.namingType)
+
+    try:
+        members = cl.getVolumeSet(vvsetName).get('setmembers') or []
+    except exceptions.HTTPNotFound:
+        members = []
+        if not args.dryRun:
+            cl.createVolumeSet(vvsetName, None, 'Pool of pre-created VVs')
+
+    # count pooled volumes by kind and size
+    available = {}
+    for member in members:
+        kind, size = parsePoolVVName(args.namingType, member)
+        if kind is not None:
+            available[(kind, size)] = available.get((kind, size), 0) + 1
+
+    missing = []
+    for poolSize in args.poolSizes.split(','):
+        size, count = [int(x) for x in poolSize.split(':')]
+        # same rules as createVVWithName
+        size = max(size, 256)
+        kind = poolVVKind(args.tpvv, args.tdvv, args.compression, size)
+        if kind is None:
+            print('Fully provisioned volumes are not pooled')
+            cl.logout()
+            exit(1)
+        have = available.get((kind, size), 0)
+        print('POOL {kind} {size}MiB AVAILABLE={have} MISSING={missing}'.format(kind=kind, size=size, have=have,
+                                                                                 missing=max(count - have, 0)))
+        missing += [size] * (count - have)
+
+    failed = []
+    if not args.dryRun:
+        def createPoolVV(size):
+            vvArgs = copy.copy(args)
+            vvArgs.size = size
+            vvArgs.comment = None
+            name = createPoolVVName(args.namingType, poolVVKind(args.tpvv, args.tdvv, args.compression, size), size)
+            createVVWithName(cl, name, vvArgs)
+            cl.addVolumeToVolumeSet(vvsetName, name)
+
+        for size, result, ex in runParallel(createPoolVV, missing, args.workers):
+            if ex is not None:
+                print('FAILED {size}MiB: {ex}'.format(size=size, ex=ex))
+                failed.append(size)
+
+    cache = loadCache(cl, 'pool')
+    claims = cache.get('data') if cache else {}
+    hits = claims.get('hit', 0)
+    misses = claims.get('miss', 0)
+    print('DRY_RUN={dryRun} CREATED={created} FAILED={failed} HITS={hits} MISSES={misses} HIT_RATE={rate:.1f}%'.format(
+        dryRun='YES' if args.dryRun else 'NO',
+        created=0 if args.dryRun else len(missing) - len(failed),
+        failed=len(failed),
+        hits=hits,
+        misses=misses,
+        rate=100.0 * hits / (hits + misses) if hits + misses > 0 else 0))
+
+    if failed:
+        cl.logout()
+        exit(1)
+
+
+def promoteVmClones(cl, args):
+    vmIds = prepareVmIds(args)
+
+    # virtual clones are VM disks which are virtual copies, snapshots of VM disks have one more name part
+    names = []
+    for vv in cl.getVolumes().get('members', []):
+        parts = vv.get('name').split('.')
+        if vv.get('copyType') != cl.VIRTUAL_COPY or len(parts) != 4 or parts[0] != args.namingType or parts[1] != 'vm':
+            continue
+        if vmIds and parts[2] not in vmIds:
+            continue
+        names.append(vv.get('name'))
+
+    counts = {}
+    for name, status, ex in runParallel(lambda x: promoteVirtualClone(cl, x, args.dryRun, args.live), names,
+                                        args.workers):
+        if ex is not None:
+            status = 'FAILED'
+            print('FAILED {name}: {ex}'.format(name=name, ex=ex))
+        elif status != 'NOT_VIRTUAL':
+            print('{status} {name}'.format(status=status, name=name))
+        counts[status] = counts.get(status, 0) + 1
+
+    print('DRY_RUN={dryRun} PROMOTED={promoted} PENDING={pending} EXPORTED={exported} HAS_SNAPSHOTS={snapshots} FAILED={failed}'.format(
+        dryRun='YES' if args.dryRun else 'NO',
+        promoted=counts.get('PROMOTED', 0),
+        pending=counts.get('PENDING', 0),
+        exported=counts.get('EXPORTED', 0),
+        snapshots=counts.get('HAS_SNAPSHOTS', 0),
+        failed=counts.get('FAILED', 0)))
+
+    if counts.get('FAILED'):
+        cl.logout()
+        exit(1)
+
+
+def promoteVmDisks(cl, args):
+    # virtual clone with snapshots could never be promoted
+    if args.id is not None:
+        names = [createVmCloneName(args.namingType, args.id, args.vmId)]
+    else:
+        try:
+            names = cl.getVolumeSet('{namingType}.vm.{vmId}'.format(namingType=args.namingType,
+                                                                   vmId=args.vmId)).get('setmembers') or []
+        except exceptions.HTTPNotFound:
+            names = []
+
+    for name in names:
+        status = promoteVirtualClone(cl, name, live=True)
+        if status not in ['PROMOTED', 'NOT_VIRTUAL']:
+            print('Virtual clone {name} can not be promoted before snapshot: {status}'.format(name=name, status=status))
+            cl.logout()
+            exit(1)
+
+def reclaimSpace(cl, args):
+    import subprocess
+    import xmltodict
+
+    vmIds = prepareVmIds(args)
+    vvs = dict((vv.get('name'), vv) for vv in cl.getVolumes().get('members', []))
+
+    # running VMs with thin VVs grouped by host, one VM per host is trimmed at once
+    hosts = {}
+    vmsXml = subprocess.check_output('onevm list --extended -x', shell=True)
+    vmPool = xmltodict.parse(vmsXml, force_list=('VM', 'DISK', 'HISTORY')).get('VM_POOL') or {}
+    for vm in vmPool.get('VM', []):
+        if vm.get('STATE') != '3' or vm.get('LCM_STATE') != '3':
+            continue
+        if vmIds and vm.get('ID') not in vmIds:
+            continue
+        history = vm.get('HISTORY_RECORDS').get('HISTORY')[-1]
+        if args.datastoreId is not None and args.datastoreId != int(history.get('DS_ID')):
+            continue
+
+        disks = (vm.get('TEMPLATE') or {}).get('DISK') or []
+        names = [createVmDiskVVName(args.namingType, vm.get('ID'), disk) for disk in disks]
+        # provisioning type 1 is fully provisioned VV
+        names = [name for name in names if name in vvs and vvs[name].get('provisioningType') != 1]
+        if names:
+            hosts.setdefault(history.get('HOSTNAME'), []).append((vm.get('DEPLOY_ID'), names))
+
+    before = {}
+    failed = []
+    libvirtUri = getLibvirtUri()
+
+    def trimHost(host):
+        trimmed = []
+        for i, (deployId, names) in enumerate(hosts[host]):
+            print('TRIM {deployId} on {host}: {names}'.format(deployId=deployId, host=host, names=','.join(names)))
+            if args.dryRun:
+                continue
+            # spread trims out, so they do not cause I/O spikes
+            if i > 0:
+                time.sleep(args.interval)
+            for name in names:
+                before[name] = cl.getVolume(name).get('userSpace').get('usedMiB')
+            try:
+                subprocess.check_output(['ssh', host, 'virsh -c {uri} domfstrim {deployId}'.format(
+                    uri=libvirtUri, deployId=deployId)], stderr=subprocess.STDOUT)
+                trimmed += names
+            except subprocess.CalledProcessError as ex:
+                failed.append(deployId)
+                print('FAILED {deployId} on {host}: {output}'.format(deployId=deployId, host=host,
+                                                                    output=ex.output.decode('utf-8', 'replace').strip()))
+        return trimmed
+
+    trimmed = []
+    for host, names, ex in runParallel(trimHost, list(hosts), args.workers):
+        if ex is not None:
+            print('FAILED {host}: {ex}'.format(host=host, ex=ex))
+            failed.append(host)
+        else:
+            trimmed += names
+
+    # array frees trimmed space asynchronously
+    reclaimed = 0
+    if trimmed:
+        time.sleep(args.settleTime)
+        after = dict((vv.get('name'), vv.get('userSpace').get('usedMiB')) for vv in cl.getVolumes().get('members', []))
+        for name in trimmed:
+            reclaimed += before[name] - after.get(name, before[name])
+            print('VV {name} BEFORE={before} AFTER={after} RECLAIMED={reclaimed}'.format(
+                name=name, before=before[name], after=after.get(name), reclaimed=before[name] - after.get(name, before[name])))
+
+    print('DRY_RUN={dryRun} VMS={vms} TRIMMED_VVS={trimmed} FAILED={failed} RECLAIMED_MIB={reclaimed}'.format(
+        dryRun='YES' if args.dryRun else 'NO',
+        vms=sum(len(vms) for vms in hosts.values()),
+        trimmed=len(trimmed),
+        failed=len(failed),
+        reclaimed=reclaimed))
+
+    # cron must see failed trims
+    if failed:
+        cl.logout()
+        exit(1)
+
+def reconcileOrphans(cl, args):
+    import subprocess
+    import xmltodict
+
+    # OpenNebula side in one listing per pool
+    vmDisks = {}
+    vmsXml = subprocess.check_output('onevm list --extended -x', shell=True)
+    vmPool = xmltodict.parse(vmsXml, force_list=('VM', 'DISK')).get('VM_POOL') or {}
+    for vm in vmPool.get('VM', []):
+        disks = (vm.get('TEMPLATE') or {}).get('DISK') or []
+        vmDisks[vm.get('ID')] = [disk.get('DISK_ID') for disk in disks]
+
+    imagesXml = subprocess.check_output('oneimage list -x', shell=True)
+    imagePool = xmltodict.parse(imagesXml, force_list=('IMAGE',)).get('IMAGE_POOL') or {}
+    imageIds = [image.get('ID') for image in imagePool.get('IMAGE', [])]
+
+    hostsXml = subprocess.check_output('onehost list -x', shell=True)
+    hostPool = xmltodict.parse(hostsXml, force_list=('HOST',)).get('HOST_POOL') or {}
+    oneHosts = [host.get('NAME') for host in hostPool.get('HOST', [])]
+
+    # datastore cp and clone export images to bridge hosts, which need not be OpenNebula hosts
+    datastoresXml = subprocess.check_output('onedatastore list -x', shell=True)
+    datastorePool = xmltodict.parse(datastoresXml, force_list=('DATASTORE',)).get('DATASTORE_POOL') or {}
+    bridgeHosts = set()
+    for datastore in datastorePool.get('DATASTORE', []):
+        bridgeHosts.update(((datastore.get('TEMPLATE') or {}).get('BRIDGE_LIST') or '').split())
+
+    # array side in one listing per object type
+    vvs = cl.getVolumes().get('members', [])
+    vluns = cl.getVLUNs().get('members', [])
+    vvsets = cl.getVolumeSets().get('members', [])
+    hosts = cl.getHosts().get('members', [])
+
+    # <TYPE>.<IMAGE ID>[.<SNAP ID>] and <TYPE>.vm.<VM ID>.<DISK ID>[.<SNAP ID>], promotion leaves .p and .v copies
+    orphanVVs = []
+    promotions = []
+    names = [vv.get('name') for vv in vvs]
+    creationTimes = dict((vv.get('name'), vv.get('creationTimeSec', 0)) for vv in vvs)
+    minTime = time.time() - args.minAge * 3600
+    for vv in vvs:
+        name = vv.get('name')
+        parts = name.split('.')
+        if parts[0] != args.namingType or len(parts) < 2 or parts[1] == 'pool':
+            continue
+        if vv.get('creationTimeSec', 0) > minTime:
+            continue
+
+        reason = None
+        if parts[1] == 'vm' and len(parts) >= 4:
+            if parts[2] not in vmDisks:
+                reason = 'VM {vmId} does not exist'.format(vmId=parts[2])
+            elif len(parts) == 5 and parts[4] in ['p', 'v']:
+                promotions.append(name)
+            elif len(parts) == 4 and parts[3] != 'cp' and parts[3] not in vmDisks[parts[2]]:
+                reason = 'disk {diskId} is not attached to VM {vmId}'.format(diskId=parts[3], vmId=parts[2])
+        elif parts[1].isdigit() and len(parts) <= 3:
+            if parts[1] not in imageIds:
+                reason = 'image {imageId} does not exist'.format(imageId=parts[1])
+        else:
+            continue
+
+        if reason is not None:
+            orphanVVs.append((name, reason))
+
+    orphanNames = [name for name, reason in orphanVVs]
+
+    # snapshot of VM disk goes with the disk
+    for name in names:
+        parts = name.split('.')
+        if len(parts) == 5 and '.'.join(parts[:4]) in orphanNames and name not in orphanNames:
+            orphanVVs.append((name, 'snapshot of orphan {name}'.format(name='.'.join(parts[:4]))))
+            orphanNames.append(name)
+
+    orphanVLUNs = []
+    for vlun in vluns:
+        volumeName = vlun.get('volumeName')
+        if not volumeName.startswith(args.namingType + '.') or not vlun.get('hostname'):
+            continue
+        vlunId = (volumeName, vlun.get('lun'), vlun.get('hostname'))
+        if vlunId in [item for item, reason in orphanVLUNs]:
+            continue
+        if volumeName in orphanNames:
+            orphanVLUNs.append((vlunId, 'VV is orphan'))
+        elif vlun.get('hostname') not in oneHosts and vlun.get('hostname') not in bridgeHosts:
+            # export of running import or clone is not older than its VV
+            if creationTimes.get(volumeName, 0) > minTime:
+                continue
+            orphanVLUNs.append((vlunId, 'host is not in OpenNebula'))
+
+    orphanVVSets = []
+    vvsetPrefix = '{namingType}.vm.'.format(namingType=args.namingType)
+    for vvset in vvsets:
+        vvsetName = vvset.get('name')
+        if not vvsetName.startswith(vvsetPrefix):
+            continue
+        members = [member for member in vvset.get('setmembers') or [] if member not in orphanNames]
+        if vvsetName[len(vvsetPrefix):] not in vmDisks:
+            orphanVVSets.append((vvsetName, 'VM {vmId} does not exist'.format(vmId=vvsetName[len(vvsetPrefix):])))
+        elif not members:
+            orphanVVSets.append((vvsetName, 'no members'))
+
+    # only hosts created for OpenNebula hypervisors, others may belong to other systems
+    orphanVLUNIds = [item for item, reason in orphanVLUNs]
+    exportedHosts = set(vlun.get('hostname') for vlun in vluns
+                        if (vlun.get('volumeName'), vlun.get('lun'), vlun.get('hostname')) not in orphanVLUNIds)
+    orphanHosts = [(host.get('name'), 'no VLUNs') for host in hosts
+                   if host.get('name') in oneHosts and host.get('name') not in exportedHosts]
+
+    for kind, items in [('VLUN', orphanVLUNs), ('VV', orphanVVs), ('VVSET', orphanVVSets), ('HOST', orphanHosts)]:
+        for item, reason in items:
+            print('ORPHAN {kind} {item}: {reason}'.format(kind=kind, item=','.join(str(i) for i in item)
+                                                          if kind == 'VLUN' else item, reason=reason))
+    for name in promotions:
+        print('PROMOTION {name}: left by promotion of virtual clone, run promoteVmClones'.format(name=name))
+
+    failed = []
+    if not args.dryRun:
+        def deleteVV(name):
+            forgetVirtualClone(cl, name)
+            if args.softDelete:
+                cl.modifyVolume(name, {'expirationHours': 168})
+            else:
+                cl.deleteVolume(name)
+
+        # exports first, snapshots before their parents, VV sets and hosts last
+        stages = [(lambda x: cl.deleteVLUN(*x), orphanVLUNIds)]
+        for depth in sorted(set(len(name.split('.')) for name in orphanNames), reverse=True):
+            stages.append((deleteVV, [name for name in orphanNames if len(name.split('.')) == depth]))
+        stages.append((cl.deleteVolumeSet, [item for item, reason in orphanVVSets]))
+        stages.append((cl.deleteHost, [item for item, reason in orphanHosts]))
+
+        for func, items in stages:
+            for item, result, ex in runParallel(func, items, args.workers, args.rate):
+                if ex is not None and not isinstance(ex, exceptions.HTTPNotFound):
+                    print('FAILED {item}: {ex}'.format(item=item, ex=ex))
+                    failed.append(item)
+
+    print('DRY_RUN={dryRun} VV={vv} VLUN={vlun} VVSET={vvset} HOST={host} PROMOTION={promotion} FAILED={failed}'.format(
+        dryRun='YES' if args.dryRun else 'NO',
+        vv=len(orphanVVs),
+        vlun=len(orphanVLUNs),
+        vvset=len(orphanVVSets),
+        host=len(orphanHosts),
+        promotion=len(promotions),
+        failed=len(failed)))
+
+    if failed:
+        cl.logout()
+        exit(1)
+
+def governorStats(cl, args):
+    import fcntl
+
+    # slots held by running processes
+    lockDir = getGovernorDir(cl)
+    inFlight = 0
+    for slot in range(args.governorSlots):
+        with open(getGovernorSlotFile(lockDir, slot), 'w') as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                fcntl.flock(lock, fcntl.LOCK_UN)
+            except (IOError, OSError):
+                inFlight += 1
+
+    print('SLOTS={slots} IN_FLIGHT={inFlight} WAITING_HIGH={waiting}'.format(slots=args.governorSlots, inFlight=inFlight,
+                                                                            waiting=len(getGovernorWaiting(lockDir))))
+
+    cache = loadCache(cl, 'governor')
+    waits = cache.get('data') if cache else {}
+    for priority in ['high', 'normal', 'low']:
+        wait = waits.get(priority, {})
+        calls = wait.get('calls', 0)
+        print('PRIORITY={priority} CALLS={calls} WAIT_AVG={avg:.0f}ms WAIT_MAX={max:.0f}ms'.format(
+            priority=priority,
+            calls=calls,
+            avg=1000.0 * wait.get('wait', 0) / calls if calls > 0 else 0,
+            max=1000.0 * wait.get('max', 0)))
+
+    if args.reset:
+        updateCache(cl, 'governor', lambda data: {})
+
+
+def qosController(cl, args):
+    import json
+
+    vvsetPrefix = '{namingType}.vm.'.format(namingType=args.namingType)
+    vmIds = prepareVmIds(args)
+
+    # recorded samples for offline replay
+    if args.replay:
+        with open(args.replay) as f:
+            replay = [json.loads(line) for line in f if line.strip()]
+        # 0 iterations would mean running forever
+        if not replay:
+            print('Replay file {file} has no samples'.format(file=args.replay))
+            exit(1)
+        args.dryRun = True
+        args.interval = 0
+        args.iterations = len(replay)
+
+    rules = {}
+    streaks = {}
+    iteration = 0
+    while args.iterations == 0 or iteration < args.iterations:
+        if iteration > 0:
+            time.sleep(args.interval)
+
+        if args.replay:
+            sample = replay[iteration]
+            # keep rules modified by controller, take only new ones from recording
+            for vvsetName, qos in sample.get('rules').items():
+                rules.setdefault(vvsetName, qos)
+        else:
+            sample = {'time': int(time.time()), 'stats': {}, 'rules': {}}
+            rules = {}
+            for qos in cl.queryQoSRules().get('members', []):
+                if qos.get('name', '').startswith(vvsetPrefix):
+                    rules[qos.get('name')] = {k: qos.get(k) for k in ('ioMinGoal', 'ioMaxLimit', 'bwMinGoalKB', 'bwMaxLimitKB')}
+            sample['rules'] = rules
+            sample['stats'] = getVVSetStatistics(cl, vvsetPrefix)
+
+            if args.record:
+                with open(args.record, 'a') as f:
+                    f.write(json.dumps(sample) + '\n')
+
+        iteration += 1
+        changed = 0
+        for vvsetName, stats in sorted(sample.get('stats').items()):
+            qos = rules.get(vvsetName)
+            if qos is None:
+                continue
+            if vmIds and vvsetName[len(vvsetPrefix):] not in vmIds:
+                continue
+
+            newRules = {}
+            for dimension, minKey, maxKey, floor, ceiling in (
+                    ('iops', 'ioMinGoal', 'ioMaxLimit', args.iopsFloor, args.iopsCeiling),
+                    ('kbps', 'bwMinGoalKB', 'bwMaxLimitKB', args.bwFloor, args.bwCeiling)):
+                limit = qos.get(maxKey)
+                if ceiling == 0 or not limit:
+                    continue
+                streakKey = (vvsetName, dimension)
+                newLimit, streaks[streakKey] = qosControllerStep(limit, stats.get(dimension, 0), stats.get('latency', 0),
+                                                                 floor, ceiling, streaks.get(streakKey, 0), args)
+                if newLimit != limit:
+                    # min goal and max limit must be set together
+                    newRules[minKey] = min(qos.get(minKey) or 1, newLimit)
+                    newRules[maxKey] = newLimit
+
+            if not newRules:
+                continue
+
+            changed += 1
+            print('MODIFY {name} IOPS={ioOld}->{ioNew} BW={bwOld}->{bwNew}'.format(
+                name=vvsetName,
+                ioOld=qos.get('ioMaxLimit'), ioNew=newRules.get('ioMaxLimit', qos.get('ioMaxLimit')),
+                bwOld=qos.get('bwMaxLimitKB'), bwNew=newRules.get('bwMaxLimitKB', qos.get('bwMaxLimitKB'))))
+
+            if not args.dryRun:
+                try:
+                    cl.modifyQoSRules(vvsetName, newRules)
+                except exceptions.ClientException as ex:
+                    print('FAILED {name}: {ex}'.format(name=vvsetName, ex=ex))
+                    continue
+            qos.update(newRules)
+
+        print('SAMPLE={iteration} TIME={time} VVSETS={vvsets} CHANGED={changed} DRY_RUN={dryRun}'.format(
+            iteration=iteration, time=sample.get('time'), vvsets=len(sample.get('stats')), changed=changed,
+            dryRun='YES' if args.dryRun else 'NO'))
+
+
 # ----------------
 # Helper functions
 # ----------------
@@ -868,6 +1966,46 @@ def createVVName(namingType, id):
 def createVmCloneName(namingType, id, vmId):
     return '{namingType}.vm.{vmId}.{id}'.format(namingType=namingType, id=id, vmId=vmId)
 
+def createVmDiskVVName(namingType, vmId, disk):
+    # non-persistent and volatile disks are VM clones, persistent images are used directly
+    if disk.get('CLONE') == 'YES' or disk.get('SOURCE') is None or disk.get('SOURCE') == '':
+        return createVmCloneName(namingType, disk.get('DISK_ID'), vmId)
+    return disk.get('SOURCE').split(':')[0]
+
+def createPoolVVSetName(namingType):
+    return '{namingType}.pool'.format(namingType=namingType)
+
+def createPoolVVName(namingType, kind, size):
+    import uuid
+
+    # name is max 31 chars
+    return '{namingType}.pool.{kind}.{size}.{suffix}'.format(namingType=namingType, kind=kind, size=size,
+                                                             suffix=uuid.uuid4().hex[:6])
+
+def parsePoolVVName(namingType, name):
+    parts = name.split('.')
+    if len(parts) != 5 or parts[0] != namingType or parts[1] != 'pool' or not parts[3].isdigit():
+        return None, None
+    return parts[2], int(parts[3])
+
+def poolVVKind(tpvv, tdvv, compression, size):
+    # provisioning as set by createVVWithName, only thin volumes are pooled
+    kind = ''
+    if tdvv == True:
+        kind += 'd'
+    elif tpvv == True and compression != True:
+        kind += 't'
+    if compression == True and size >= 16384:
+        kind += 'c'
+    elif compression == True and tdvv != True:
+        return None
+    return kind or None
+
+def createVirtualCloneMetaKey(name):
+    # metadata key on source VV, stays the same when naming type of clone changes
+    parts = name.split('.')
+    return 'vc.{vmId}.{id}'.format(vmId=parts[-2], id=parts[-1])
+
 def createSnapshotNameAndMetaKey(srcName, snapId):
     name = '{srcName}.{snapId}'.format(srcName=srcName, snapId=snapId)
     metaKey = 'snap{snapId}'.format(snapId=snapId)
@@ -875,7 +2013,9 @@ def createSnapshotNameAndMetaKey(srcName, snapId):
     return name, metaKey
 
 def createVVWithName(cl, name, args):
-    cpgName = args.cpg
+    cpgName = selectCPG(cl, args)
+    # following calls like copyVolume use the same CPG
+    args.cpg = cpgName
 
     optional = {'snapCPG': cpgName}
     if args.tpvv == True and args.tdvv != True and args.compression != True:
@@ -898,7 +2038,627 @@ def createVVWithName(cl, name, args):
 
     return cl.getVolume(name)
 
+def claimPoolVV(cl, name, args):
+    import random
+
+    vvsetName = createPoolVVSetName(args.namingType)
+    try:
+        members = cl.getVolumeSet(vvsetName).get('setmembers') or []
+    except exceptions.HTTPNotFound:
+        return None
+
+    size = max(args.size, 256)
+    kind = poolVVKind(args.tpvv, args.tdvv, args.compression, size)
+    if kind is None:
+        return None
+
+    candidates = []
+    for member in members:
+        poolKind, poolSize = parsePoolVVName(args.namingType, member)
+        if poolKind == kind and poolSize <= size:
+            candidates.append((poolSize, member))
+
+    # biggest volume needs least growing, random order of same sizes lowers conflicts of parallel claims
+    random.shuffle(candidates)
+    candidates.sort(key=lambda x: x[0], reverse=True)
+
+    cpgNames = args.cpg.split(',')
+    for poolSize, poolName in candidates:
+        try:
+            vv = cl.getVolume(poolName)
+            if vv.get('userCPG') not in cpgNames:
+                continue
+            # rename is the claim, it fails when other process claimed the volume first
+            modify = {'newName': name}
+            if args.comment:
+                modify['comment'] = args.comment
+            cl.modifyVolume(poolName, modify)
+        except exceptions.ClientException:
+            continue
+
+        try:
+            cl.removeVolumeFromVolumeSet(vvsetName, name)
+        except exceptions.HTTPNotFound:
+            pass
+
+        if poolSize < size:
+            cl.growVolume(name, size - poolSize)
+
+        args.cpg = vv.get('userCPG')
+        return vv
+
+    return None
+
+def countPoolClaim(cl, hit):
+    key = 'hit' if hit else 'miss'
+
+    def count(claims):
+        claims[key] = claims.get(key, 0) + 1
+        return claims
+
+    updateCache(cl, 'pool', count)
+
+def createVirtualClone(cl, name, args):
+    import json
+
+    optional = {'readOnly': False}
+    if args.comment:
+        optional['comment'] = args.comment
+
+    cl.createSnapshot(name, args.srcName, optional)
+
+    # how to create independent VV on promotion
+    spec = {'cpg': args.cpg, 'cpgPolicy': args.cpgPolicy, 'tpvv': args.tpvv, 'tdvv': args.tdvv,
+            'compression': args.compression}
+    cl.setVolumeMetaData(name, 'cloneOf', args.srcName)
+    cl.setVolumeMetaData(name, 'cloneSpec', json.dumps(spec))
+    cl.setVolumeMetaData(args.srcName, createVirtualCloneMetaKey(name), name)
+
+    return cl.getVolume(name)
+
+def promoteVirtualClone(cl, name, dryRun=False, live=False):
+    import json
+
+    try:
+        srcName = cl.getVolumeMetaData(name, 'cloneOf').get('value')
+    except exceptions.HTTPNotFound:
+        return 'NOT_VIRTUAL'
+
+    # exported clone is copied with help of the host which uses it, only when VM state allows it,
+    # disk of running VM is switched by block copy and pivot only when asked for
+    user = None
+    if isExported(cl, name):
+        user = getVirtualCloneUser(cl, name)
+        if user is None or (user.get('running') and not live):
+            return 'EXPORTED'
+
+    # snapshots would be lost
+    spec = None
+    for data in cl.getAllVolumeMetaData(name).get('members'):
+        if data.get('key').startswith('snap'):
+            return 'HAS_SNAPSHOTS'
+        if data.get('key') == 'cloneSpec':
+            spec = json.loads(data.get('value'))
+
+    if dryRun:
+        return 'PENDING'
+
+    vv = cl.getVolume(name)
+    copyName = '{name}.p'.format(name=name)
+    oldName = '{name}.v'.format(name=name)
+
+    # physical copy with the same provisioning as full clone
+    vvArgs = argparse.Namespace(cpgCacheTtl=60, size=vv.get('sizeMiB'), comment=vv.get('comment'), **spec)
+    createVVWithName(cl, copyName, vvArgs)
+
+    if user is None:
+        task = cl.copyVolume(name, copyName, None, {'priority': 3, 'skipZero': True})
+        waitForTask(cl, task.get('taskid'))
+
+        if isExported(cl, name):
+            cl.deleteVolume(copyName)
+            return 'EXPORTED'
+    else:
+        try:
+            switchVirtualCloneUser(cl, name, copyName, user)
+        except Exception:
+            cl.deleteVolume(copyName)
+            raise
+
+    # swap names, WWN changes, which is fine for not exported volume or after host switched to copy
+    cl.modifyVolume(name, {'newName': oldName})
+    cl.modifyVolume(copyName, {'newName': name})
+
+    vvsetName = name.rsplit('.', 1)[0]
+    try:
+        cl.removeVolumeFromVolumeSet(vvsetName, oldName)
+        cl.addVolumeToVolumeSet(vvsetName, name)
+    except exceptions.HTTPNotFound:
+        pass
+
+    cl.deleteVolume(oldName)
+
+    try:
+        cl.removeVolumeMetaData(srcName, createVirtualCloneMetaKey(name))
+    except exceptions.HTTPNotFound:
+        pass
+
+    return 'PROMOTED'
+
+def getVirtualCloneUser(cl, name):
+    import subprocess
+    import xmltodict
+    from urllib.parse import quote
+
+    # clone of VM disk exported to the host where VM is deployed, VM running, powered off or resizing its disk
+    parts = name.split('.')
+    if len(parts) != 4 or parts[1] != 'vm':
+        return None
+
+    query = '"volumeName EQ {name}"'.format(name=name)
+    response, body = cl.http.get('/vluns?query={query}'.format(query=quote(query.encode('utf8'))))
+    vluns = [vlun for vlun in body.get('members', []) if vlun.get('hostname')]
+    if len(vluns) != 1:
+        return None
+
+    try:
+        vmXml = subprocess.check_output(['onevm', 'show', '-x', parts[2]], stderr=subprocess.STDOUT)
+    except subprocess.CalledProcessError:
+        return None
+    vm = xmltodict.parse(vmXml, force_list=('DISK', 'HISTORY')).get('VM')
+
+    # RUNNING, HOTPLUG_SNAPSHOT, DISK_SNAPSHOT and DISK_RESIZE of ACTIVE VM with running domain,
+    # DISK_SNAPSHOT_POWEROFF, DISK_SNAPSHOT_SUSPENDED and DISK_RESIZE_POWEROFF of ACTIVE VM, SUSPENDED or POWEROFF
+    runningStates = ['3', '24', '57', '62']
+    if not ((vm.get('STATE') == '3' and vm.get('LCM_STATE') in runningStates + ['51', '54', '63']) or
+            vm.get('STATE') in ['5', '8']):
+        return None
+
+    history = vm.get('HISTORY_RECORDS').get('HISTORY')[-1]
+    disks = [disk for disk in (vm.get('TEMPLATE') or {}).get('DISK') or [] if disk.get('DISK_ID') == parts[3]]
+    if history.get('HOSTNAME') != vluns[0].get('hostname') or not disks:
+        return None
+
+    return {
+        'host': vluns[0].get('hostname'),
+        'lun': vluns[0].get('lun'),
+        'deployId': vm.get('DEPLOY_ID'),
+        'target': disks[0].get('TARGET'),
+        'path': '{location}/{dsId}/{vmId}/disk.{diskId}'.format(location=history.get('DS_LOCATION').rstrip('/'),
+                                                               dsId=history.get('DS_ID'), vmId=parts[2],
+                                                               diskId=parts[3]),
+        'running': vm.get('STATE') == '3' and vm.get('LCM_STATE') in runningStates
+    }
+
+def switchVirtualCloneUser(cl, name, copyName, user):
+    host = user.get('host')
+
+    # domain which writes to the clone is mirrored to the copy by qemu, otherwise array copies it
+    libvirtUri = getLibvirtUri()
+    state = runOnHost(host, 'virsh -c {uri} domstate {deployId} 2>/dev/null || echo absent'.format(
+        uri=libvirtUri, deployId=user.get('deployId'))).strip()
+    online = state in ['running', 'paused']
+    if online != user.get('running'):
+        raise RuntimeError('Domain {deployId} on {host} is {state}, VM state does not match'.format(
+            deployId=user.get('deployId'), host=host, state=state))
+
+    if not online:
+        task = cl.copyVolume(name, copyName, None, {'priority': 3, 'skipZero': True})
+        waitForTask(cl, task.get('taskid'))
+
+    location = cl.createVLUN(copyName, None, host, None, None, None, True)
+    lun = location.split(',')[1]
+    wwn = cl.getVolume(copyName).get('wwn').lower()
+    oldWwn = cl.getVolume(name).get('wwn').lower()
+
+    script = getHostScript('discover_lun', lun, wwn)
+    if online:
+        script += '\nvirsh -c {uri} blockcopy {deployId} {target} --dest "$DEV" --blockdev --reuse-external ' \
+                  '--wait --pivot\n'.format(uri=libvirtUri, deployId=user.get('deployId'), target=user.get('target'))
+    script += '\nln -sfn "$DEV" {path}\n'.format(path=user.get('path'))
+
+    try:
+        runOnHost(host, script)
+    except Exception:
+        # host still uses the clone, drop the copy
+        try:
+            runOnHost(host, getHostScript('remove_lun', wwn))
+        finally:
+            cl.deleteVLUN(copyName, lun, host)
+        raise
+
+    # host does not use the clone anymore
+    try:
+        runOnHost(host, getHostScript('remove_lun', oldWwn))
+    except RuntimeError as ex:
+        print(ex)
+    cl.deleteVLUN(name, user.get('lun'), host)
+
+def getHostScript(function, *args):
+    import subprocess
+
+    # host side commands are generated by shared driver functions
+    scripts = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'scripts_3par.sh')
+    env = dict(os.environ, SUDO=os.environ.get('SUDO', 'sudo'))
+    return subprocess.check_output(['bash', '-c', 'source "$0" && "$@"', scripts, function] + [str(arg) for arg in args],
+                                   env=env).decode('utf-8')
+
+def getLibvirtUri():
+    import subprocess
+
+    # hosts are managed by the same URI as KVM drivers use
+    if os.environ.get('LIBVIRT_URI'):
+        return os.environ.get('LIBVIRT_URI')
+
+    kvmrc = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'etc', 'vmm', 'kvm', 'kvmrc')
+    try:
+        uri = subprocess.check_output(['bash', '-c', 'source "$0" >/dev/null 2>&1; echo "$LIBVIRT_URI"', kvmrc],
+                                      stderr=subprocess.DEVNULL).decode('utf-8').strip()
+    except subprocess.CalledProcessError:
+        uri = ''
+    return uri or 'qemu:///system'
+
+def runOnHost(host, script):
+    import subprocess
+
+    try:
+        return subprocess.check_output(['ssh', host, 'bash -s'], input=script.encode('utf-8'),
+                                       stderr=subprocess.STDOUT).decode('utf-8', 'replace')
+    except subprocess.CalledProcessError as ex:
+        raise RuntimeError('Command on {host} failed: {output}'.format(
+            host=host, output=ex.output.decode('utf-8', 'replace').strip()))
+
+def forgetVirtualClone(cl, name):
+    try:
+        srcName = cl.getVolumeMetaData(name, 'cloneOf').get('value')
+        cl.removeVolumeMetaData(srcName, createVirtualCloneMetaKey(name))
+    except exceptions.HTTPNotFound:
+        pass
+
+def isExported(cl, name):
+    try:
+        cl.getVLUN(name)
+        return True
+    except exceptions.HTTPNotFound:
+        return False
+
+def waitForTask(cl, taskId, interval=5):
+    while True:
+        task = cl.getTask(taskId)
+        if task.get('status') != cl.TASK_ACTIVE:
+            break
+        time.sleep(interval)
+
+    if task.get('status') != cl.TASK_DONE:
+        raise RuntimeError('Task {id} did not finish: {status}'.format(id=taskId, status=task.get('status')))
+
+def selectCPG(cl, args):
+    cpgNames = args.cpg.split(',')
+    if len(cpgNames) == 1:
+        return cpgNames[0]
+
+    cpgStats = getCPGStats(cl, cpgNames, args.cpgCacheTtl)
+    size = max(args.size, 256)
+    fits = [cpgName for cpgName in cpgNames if cpgStats[cpgName]['free'] >= size]
+
+    if not fits:
+        # no CPG has enough space, let the array decide with the most free one
+        cpgName = max(cpgNames, key=lambda x: cpgStats[x]['free'])
+    elif args.cpgPolicy == 'fill':
+        # first CPG in user defined order
+        cpgName = fits[0]
+    elif args.cpgPolicy == 'free':
+        cpgName = max(fits, key=lambda x: cpgStats[x]['free'])
+    else:
+        # balance free space and load
+        maxFree = max(cpgStats[x]['free'] for x in fits)
+        cpgName = max(fits, key=lambda x: cpgStats[x]['free'] / maxFree * (1 - min(cpgStats[x]['load'], 100) / 100.0))
+
+    # account new volume so other placements within cache TTL see it
+    cpgStats[cpgName]['free'] -= size
+    saveCache(cl, 'cpg', cpgStats, keepTime=True)
+
+    return cpgName
+
+def getCapacitySnapshot(cl, cpgNames, disks):
+    # compact structure shared by monitorCPG and exportMetrics, VV sizes are [usedMiB, sizeMiB]
+    snapshot = {'api': cl.api_url, 'time': time.time(), 'cpgs': {}, 'vvs': {}}
+    for cpgName in cpgNames:
+        cpgData = cl.getCPG(cpgName)
+        cpgAvailableSpace = cl.getCPGAvailableSpace(cpgName)
+        snapshot['cpgs'][cpgName] = [cpgData.get('UsrUsage').get('usedMiB'), cpgAvailableSpace.get('usableFreeMiB')]
+
+    if disks == True:
+        for vv in cl.getVolumes().get('members'):
+            snapshot['vvs'][vv.get('name')] = [vv.get('userSpace').get('usedMiB'), vv.get('sizeMiB')]
+
+    return snapshot
+
+def getExporterSnapshot(url, api, cpgNames):
+    import json
+    import sys
+    from urllib.error import HTTPError, URLError
+    from urllib.request import urlopen
+
+    try:
+        with urlopen(url.rstrip('/') + '/snapshot', timeout=30) as response:
+            snapshot = json.loads(response.read().decode('utf-8'))
+    except HTTPError as ex:
+        # exporter has no recent snapshot, anything else is misconfiguration
+        if ex.code != 503:
+            raise
+        sys.stderr.write('Exporter {url} has no recent snapshot, reading array\n'.format(url=url))
+        return None
+    except (URLError, OSError) as ex:
+        sys.stderr.write('Exporter {url} is not reachable ({ex}), reading array\n'.format(url=url, ex=ex))
+        return None
+
+    # exporter serves just one array
+    if snapshot.get('api') != api:
+        print('Exporter {url} serves {api}'.format(url=url, api=snapshot.get('api')))
+        exit(1)
+    missing = [cpgName for cpgName in cpgNames if cpgName not in snapshot.get('cpgs')]
+    if missing:
+        print('Exporter {url} does not export CPG {cpg}'.format(url=url, cpg=','.join(missing)))
+        exit(1)
+
+    return snapshot
+
+def sumCPGCapacity(snapshot, cpgNames):
+    used = sum(snapshot.get('cpgs')[cpgName][0] for cpgName in cpgNames)
+    free = sum(snapshot.get('cpgs')[cpgName][1] for cpgName in cpgNames)
+    return used, free
+
+def printCPGCapacity(snapshot, cpgNames):
+    used, free = sumCPGCapacity(snapshot, cpgNames)
+
+    print('USED_MB={used}'.format(used=used))
+    print('TOTAL_MB={total}'.format(total=used + free))
+    print('FREE_MB={free}'.format(free=free))
+
+def formatMetrics(snapshot, state):
+    def label(value):
+        return value.replace('\\', '\\\\').replace('"', '\\"')
+
+    lines = [
+        '# TYPE threepar_exporter_refreshes_total counter',
+        'threepar_exporter_refreshes_total {value}'.format(value=state['refreshes']),
+        '# TYPE threepar_exporter_refresh_errors_total counter',
+        'threepar_exporter_refresh_errors_total {value}'.format(value=state['errors']),
+        '# TYPE threepar_exporter_refresh_duration_seconds gauge',
+        'threepar_exporter_refresh_duration_seconds {value:.3f}'.format(value=state['duration'])
+    ]
+    if snapshot is None:
+        return '\n'.join(lines) + '\n'
+
+    lines += [
+        '# TYPE threepar_exporter_last_refresh_timestamp_seconds gauge',
+        'threepar_exporter_last_refresh_timestamp_seconds {value:.0f}'.format(value=snapshot.get('time'))
+    ]
+    for metric, index, items in [('cpg_used_mib', 0, snapshot.get('cpgs')), ('cpg_free_mib', 1, snapshot.get('cpgs')),
+                                 ('vv_used_mib', 0, snapshot.get('vvs')), ('vv_size_mib', 1, snapshot.get('vvs'))]:
+        kind = metric.split('_')[0]
+        lines.append('# TYPE threepar_{metric} gauge'.format(metric=metric))
+        for name, values in sorted(items.items()):
+            lines.append('threepar_{metric}{{{kind}="{name}"}} {value}'.format(metric=metric, kind=kind, name=label(name),
+                                                                              value=values[index]))
+
+    return '\n'.join(lines) + '\n'
+
+def getCPGStats(cl, cpgNames, ttl):
+    cache = loadCache(cl, 'cpg')
+    if cache and time.time() - cache.get('time') <= ttl and all(cpgName in cache.get('data') for cpgName in cpgNames):
+        return cache.get('data')
+
+    # load of all CPGs from System Reporter in one call, it may be unlicensed
+    load = {}
+    try:
+        response, body = cl.http.get('/systemreporter/attime/cpgstatistics/hires;groupby:name')
+        for member in body.get('members', []):
+            load[member.get('name')] = member.get('busyPct', 0.0)
+    except exceptions.ClientException:
+        pass
+
+    cpgStats = {}
+    for cpgName in cpgNames:
+        cpgStats[cpgName] = {
+            'free': cl.getCPGAvailableSpace(cpgName).get('usableFreeMiB'),
+            'load': load.get(cpgName, 0.0)
+        }
+    saveCache(cl, 'cpg', cpgStats)
+
+    return cpgStats
+
+def getPortLoad(cl, decay, ttl):
+    cache = loadCache(cl, 'port')
+    if cache and time.time() - cache.get('time') <= ttl:
+        return cache.get('data')
+
+    # previous averages are kept even when cache expired
+    portLoad = cache.get('data') if cache else {}
+    # System Reporter may be unlicensed, without samples ports are sorted by usage count
+    try:
+        response, body = cl.http.get('/systemreporter/attime/portstatistics/hires;groupby:node,slot,cardPort')
+    except exceptions.ClientException:
+        body = {}
+    for member in body.get('members', []):
+        portName = createPortName(member)
+        sample = {
+            'iops': member.get('IO', {}).get('total', 0.0),
+            'kbps': member.get('KBytes', {}).get('total', 0.0)
+        }
+        if portName in portLoad:
+            for k, v in sample.items():
+                sample[k] = decay * v + (1 - decay) * portLoad[portName].get(k, 0.0)
+        portLoad[portName] = sample
+    saveCache(cl, 'port', portLoad)
+
+    return portLoad
+
+def getCacheFile(cl, kind):
+    import hashlib
+    import tempfile
+    import os
+
+    apiHash = hashlib.sha1(cl.api_url.encode('utf-8')).hexdigest()[:12]
+    return os.path.join(tempfile.gettempdir(), 'one-3par-{kind}-{hash}.json'.format(kind=kind, hash=apiHash))
+
+def loadCache(cl, kind):
+    import json
+
+    try:
+        with open(getCacheFile(cl, kind)) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return None
+
+def saveCache(cl, kind, data, keepTime=False):
+    import json
+    import os
+
+    # updated data must not extend cache lifetime
+    cacheTime = time.time()
+    if keepTime:
+        cache = loadCache(cl, kind)
+        if cache:
+            cacheTime = cache.get('time')
+
+    cacheFile = getCacheFile(cl, kind)
+    tmpFile = '{file}.{pid}'.format(file=cacheFile, pid=os.getpid())
+    try:
+        with open(tmpFile, 'w') as f:
+            json.dump({'time': cacheTime, 'data': data}, f)
+        os.replace(tmpFile, cacheFile)
+    except (IOError, OSError):
+        pass
+
+def updateCache(cl, kind, update):
+    import fcntl
+
+    # updates of parallel driver actions must not be lost
+    with open(getCacheFile(cl, kind) + '.lock', 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        cache = loadCache(cl, kind)
+        saveCache(cl, kind, update(cache.get('data') if cache else {}))
+
+def getGovernorDir(cl):
+    lockDir = getCacheFile(cl, 'governor') + '.d'
+    try:
+        os.makedirs(lockDir)
+    except OSError:
+        pass
+    return lockDir
+
+def getGovernorSlotFile(lockDir, slot):
+    return os.path.join(lockDir, 'slot.{slot}'.format(slot=slot))
+
+def getGovernorWaiting(lockDir):
+    waiting = []
+    try:
+        markers = os.listdir(lockDir)
+    except OSError:
+        return waiting
+    for marker in markers:
+        if not marker.startswith('high.'):
+            continue
+        # marker of killed process
+        try:
+            os.kill(int(marker.split('.')[1]), 0)
+            waiting.append(marker)
+        except (OSError, ValueError):
+            try:
+                os.remove(os.path.join(lockDir, marker))
+            except OSError:
+                pass
+    return waiting
+
+def governWSAPI(cl, slots, priority):
+    import fcntl
+    import threading
+
+    # high priority can use all slots, lower priorities leave some for high and wait while high is waiting
+    usable = {'high': slots, 'normal': max(1, slots - 1), 'low': max(1, slots // 2)}[priority]
+    waits = {'calls': 0, 'wait': 0.0, 'max': 0.0}
+    waitsLock = threading.Lock()
+    lockDir = getGovernorDir(cl)
+
+    def tryAcquire():
+        for slot in range(usable):
+            lock = open(getGovernorSlotFile(lockDir, slot), 'w')
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return lock
+            except (IOError, OSError):
+                lock.close()
+        return None
+
+    def acquire():
+        start = time.time()
+        if priority == 'high':
+            lock = tryAcquire()
+            if lock:
+                return lock, 0.0
+            # nothing else to check, so block on one of slots, others hold their slot only for one call
+            marker = os.path.join(lockDir, 'high.{pid}.{thread}'.format(pid=os.getpid(),
+                                                                     thread=threading.current_thread().ident))
+            open(marker, 'w').close()
+            try:
+                lock = open(getGovernorSlotFile(lockDir, (os.getpid() + threading.current_thread().ident) % usable), 'w')
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                return lock, time.time() - start
+            finally:
+                os.remove(marker)
+
+        # lower priorities also wait for high priority waiters, back off exponentially
+        delay = 0.05
+        while True:
+            if not getGovernorWaiting(lockDir):
+                lock = tryAcquire()
+                if lock:
+                    return lock, time.time() - start
+            time.sleep(delay)
+            delay = min(delay * 2, 1.0)
+
+    def governed(call):
+        def governedCall(*args, **kwargs):
+            # session login and logout do not change the array
+            if args and args[0].startswith('/credentials'):
+                return call(*args, **kwargs)
+            lock, waited = acquire()
+            with waitsLock:
+                waits['calls'] += 1
+                waits['wait'] += waited
+                waits['max'] = max(waits['max'], waited)
+            try:
+                return call(*args, **kwargs)
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+                lock.close()
+        return governedCall
+
+    for method in ['post', 'put', 'delete']:
+        setattr(cl.http, method, governed(getattr(cl.http, method)))
+
+    return waits
+
+def saveGovernorWaits(cl, priority, waits):
+    if waits['calls'] == 0:
+        return
+
+    def add(data):
+        total = data.get(priority, {})
+        data[priority] = {
+            'calls': total.get('calls', 0) + waits['calls'],
+            'wait': total.get('wait', 0.0) + waits['wait'],
+            'max': max(total.get('max', 0.0), waits['max'])
+        }
+        return data
+
+    updateCache(cl, 'governor', add)
+
 def deleteVVWithName(cl, name):
+    forgetVirtualClone(cl, name)
+
     if args.softDelete:
         cl.modifyVolume(name, {'expirationHours': 168})
         # find and delete snapshots
@@ -919,6 +2679,15 @@ def deleteVVWithName(cl, name):
                 if key.startswith('snap'):
                     snap = data.get('value')
                     cl.deleteVolume(snap)
+                # virtual clones must become independent first
+                if key.startswith('vc.'):
+                    clone = data.get('value')
+                    status = promoteVirtualClone(cl, clone, live=True)
+                    if status not in ['PROMOTED', 'NOT_VIRTUAL']:
+                        print('Virtual clone {clone} of {name} can not be promoted: {status}'.format(
+                            clone=clone, name=name, status=status))
+                        cl.logout()
+                        exit(1)
 
             # try delete again
             done = False
@@ -967,6 +2736,105 @@ def prepareQosRules(args):
 
     return qosRules
 
+def qosRulesChanged(qos, qosRules):
+    for k, v in qosRules.items():
+        if k == 'enable':
+            k = 'enabled'
+        if qos.get(k) != v:
+            return True
+    return False
+
+def qosControllerStep(limit, usage, latency, floor, ceiling, streak, args):
+    # limit 0 would stop all I/O of VV set
+    floor = max(1, floor)
+
+    # limit out of allowed range is fixed immediately
+    if limit > ceiling:
+        return ceiling, 0
+    if limit < floor:
+        return floor, 0
+
+    if usage >= limit * args.highWatermark and (not args.maxLatency or latency <= args.maxLatency):
+        direction = 1
+    elif usage <= limit * args.lowWatermark:
+        direction = -1
+    else:
+        # inside of hysteresis band
+        return limit, 0
+
+    # count consecutive samples in the same direction
+    if streak * direction > 0:
+        streak += direction
+    else:
+        streak = direction
+    if abs(streak) < args.samples:
+        return limit, streak
+
+    if direction > 0:
+        return min(ceiling, int(limit * (1 + args.step))), 0
+    return max(floor, int(limit * (1 - args.step))), 0
+
+def getVVSetStatistics(cl, vvsetPrefix):
+    # latest high resolution sample of all VVs
+    response, body = cl.http.get('/systemreporter/attime/vvstatistics/hires;groupby:vvName')
+    vvStats = {}
+    for member in body.get('members', []):
+        vvStats[member.get('vvName')] = member
+
+    # sum stats of VV set members, latency is IOPS weighted average
+    stats = {}
+    for vvset in cl.getVolumeSets().get('members', []):
+        vvsetName = vvset.get('name')
+        if not vvsetName.startswith(vvsetPrefix):
+            continue
+        iops = kbps = latency = 0.0
+        for member in vvset.get('setmembers') or []:
+            vvStat = vvStats.get(member)
+            if vvStat is None:
+                continue
+            vvIops = vvStat.get('IO', {}).get('total', 0.0)
+            iops += vvIops
+            kbps += vvStat.get('KBytes', {}).get('total', 0.0)
+            latency += vvStat.get('serviceTimeMS', {}).get('total', 0.0) * vvIops
+        stats[vvsetName] = {'iops': iops, 'kbps': kbps, 'latency': latency / iops if iops else 0.0}
+    return stats
+
+def prepareVmIds(args):
+    if args.vmIds == "":
+        return []
+    else:
+        return args.vmIds.split(',')
+
+def runParallel(func, items, workers, rate=0):
+    from concurrent.futures import ThreadPoolExecutor
+    import threading
+
+    # optionally start at most rate calls per second
+    if rate > 0:
+        lock = threading.Lock()
+        schedule = {'next': time.time()}
+        call = func
+
+        def func(item):
+            with lock:
+                now = time.time()
+                delay = schedule['next'] - now
+                schedule['next'] = max(now, schedule['next']) + 1.0 / rate
+            if delay > 0:
+                time.sleep(delay)
+            return call(item)
+
+    # run func over items in bounded pool, return (item, result, exception) in items order
+    results = []
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        futures = [(item, executor.submit(func, item)) for item in items]
+        for item, future in futures:
+            try:
+                results.append((item, future.result(), None))
+            except Exception as ex:
+                results.append((item, None, ex))
+    return results
+
 def prepareIscsiNames(args):
     if args.iscsiNames == "":
         return []
@@ -990,16 +2858,39 @@ if args.secure == True:
 cl = client.HPE3ParClient(args.api, False, secure, None, True)
 cl.setSSHOptions(args.ip, args.username, args.password)
 
-try:
-    cl.login(args.username, args.password)
-except exceptions.HTTPUnauthorized as ex:
-    print("Login failed.")
+# replay of recorded data and reads from exporter run without array
+offline = (getattr(args, 'replay', None) is not None or args.task == 'governorStats' or
+           getattr(args, 'exporter', '') != '')
+
+# deploy actions first, deletes and maintenance last
+highPriorityTasks = ['createVV', 'cloneVV', 'createVmClone', 'createVmVV', 'exportVV', 'setupHost', 'addVolumeToVVSet',
+                     'createQosPolicy', 'growVV', 'resizeVV']
+lowPriorityTasks = ['deleteVV', 'deleteVmClone', 'unexportVV', 'deleteHost', 'deleteVolumeFromVVSet', 'deleteQosPolicy',
+                    'deleteSnapshot', 'deleteVVSetSnapshot', 'reconcileQosPolicies', 'qosController', 'fillVVPool',
+                    'promoteVmClones', 'reconcileOrphans', 'reclaimSpace']
+
+if args.governorSlots > 0 and not offline:
+    import atexit
+
+    priority = args.governorPriority
+    if priority is None:
+        priority = 'high' if args.task in highPriorityTasks else 'low' if args.task in lowPriorityTasks else 'normal'
+    governorWaits = governWSAPI(cl, args.governorSlots, priority)
+    atexit.register(saveGovernorWaits, cl, priority, governorWaits)
+
+if not offline:
+    try:
+        cl.login(args.username, args.password)
+    except exceptions.HTTPUnauthorized as ex:
+        print("Login failed.")
 
 try:
     globals()[args.task](cl, args)
-    cl.logout()
+    if not offline:
+        cl.logout()
 except Exception as ex:
     # something unexpected happened
     print(ex)
-    cl.logout()
+    if not offline:
+        cl.logout()
     exit(1)
@@ -19,6 +19,7 @@
 # -------------------------------------------------------------------------- #
 
 BLOCKDEV=blockdev
+BLKDISCARD=blkdiscard
 DMSETUP=dmsetup
 MULTIPATH=multipath
 MULTIPATHD=multipathd
@@ -42,6 +43,65 @@ function multipath_resize {
     echo "$SUDO $MULTIPATHD -k\"resize map $MAP_NAME\""
 }
 
+function multipath_grow {
+    local LUN
+    local WWN
+    local SIZE
+    LUN="$1"
+    WWN="$2"
+    SIZE="$3"
+    cat <<EOF
+        START=\$(date +%s%N)
+        DEV="/dev/mapper/3$WWN"
+
+        # LUN not discovered on this host yet, scan just for it
+        if ! DM_HOLDER=\$($SUDO $DMSETUP ls -o blkdevname | grep -Po "(?<=3$WWN\s\()[^)]+"); then
+            $(rescan_scsi_bus "$LUN")
+            $(multipath_rescan)
+            DM_HOLDER=\$($SUDO $DMSETUP ls -o blkdevname | grep -Po "(?<=3$WWN\s\()[^)]+")
+        fi
+
+        # Without multipath device there are no paths to re-read and size would never change
+        if [ -z "\$DM_HOLDER" ]; then
+            echo "Multipath device 3$WWN of LUN $LUN not found after rescan" >&2
+            exit 1
+        fi
+
+        # Re-read capacity of paths of this LUN only
+        for device in \$(ls /sys/block/\${DM_HOLDER}/slaves); do
+            echo 1 | $SUDO $TEE /sys/block/\${device}/device/rescan >/dev/null &
+        done
+        wait
+
+        # Wait until multipath device has new size
+        COUNTER=1
+        while true; do
+            $(multipath_resize "3$WWN") >/dev/null
+            CURRENT=\$($SUDO $BLOCKDEV --getsize64 \$DEV)
+            [ \$((CURRENT / 1048576)) -ge $SIZE ] && break
+            if [ \$COUNTER -ge ${RESIZE_TIMEOUT:-30} ]; then
+                echo "\$DEV has \$((CURRENT / 1048576)) MiB, expected $SIZE MiB" >&2
+                exit 1
+            fi
+            sleep 1
+            COUNTER=\$((\$COUNTER + 1))
+        done
+
+        echo "\$(( (\$(date +%s%N) - START) / 1000000 ))ms"
+EOF
+}
+
+function discard_lun {
+    local WWN
+    local PREFIX
+    WWN="$1"
+    PREFIX="$2"
+    # dd with conv=sparse skips zero blocks, so they must not hold data left from claimed or retried VV
+    if [ "$RECLAIM_DISCARD" == "YES" ]; then
+        echo "$PREFIX $SUDO $BLKDISCARD /dev/disk/by-id/wwn-0x$WWN"
+    fi
+}
+
 function rescan_scsi_bus {
   local LUN
   local FORCE
@@ -72,30 +132,74 @@ function get_vv_wwn {
   echo "$NAME_WWN" | $AWK -F: '{print $2}'
 }
 
+# Get value of attribute from describeVm record
+function get_vm_disk_attr {
+    echo "$1" | tr ' ' '\n' | awk -F= -v key="$2" '$1 == key {print substr($0, length(key) + 2)}'
+}
+
 function iscsi_login {
     local PORTALS
     local PORTALS_NUM
     PORTALS="$1"
     PORTALS_NUM="$2"
     cat <<EOF
-        CONNECTIONS=\$(sudo iscsiadm -m session -o show | awk '{gsub(",", " ")}; \$3 ~ "(${PORTALS// /|})(:|$)" {print \$3}')
-        if [ -n "\$CONNECTIONS" ]; then
-            CONNECTIONS_NUM=\$(echo "\$CONNECTIONS" | wc -l)
-        else
-            CONNECTIONS_NUM=0
-        fi
+        # Addresses of existing sessions from sysfs
+        CONNECTIONS=" "
+        for CONNECTION in /sys/class/iscsi_connection/connection*; do
+            [ -e "\$CONNECTION/persistent_address" ] || continue
+            CONNECTIONS="\$CONNECTIONS\$(cat "\$CONNECTION/persistent_address"):\$(cat "\$CONNECTION/persistent_port") "
+        done
 
-        set -e
+        CONNECTIONS_NUM=0
+        MISSING=()
         for PORTAL in $PORTALS; do
-            if [ -n "$PORTALS_NUM" ] && [ "\$CONNECTIONS_NUM" -ge "$PORTALS_NUM" ]; then
-                break
-            fi
-            if ! echo "\$CONNECTIONS" | grep -q "\$PORTAL[:,]"; then
-                sudo iscsiadm -m discovery -t sendtargets -p "\$PORTAL"
-                sudo iscsiadm -m node -l all -p "\$PORTAL"
+            if [[ "\$CONNECTIONS" == *" \$PORTAL "* || "\$CONNECTIONS" == *" \$PORTAL:"* ]]; then
                 CONNECTIONS_NUM=\$((CONNECTIONS_NUM+1))
+            else
+                MISSING+=("\$PORTAL")
             fi
         done
+
+        if [ -n "$PORTALS_NUM" ]; then
+            NEEDED=\$(($PORTALS_NUM - CONNECTIONS_NUM))
+        else
+            NEEDED=\${#MISSING[@]}
+        fi
+
+        # Login to missing portals concurrently, failed ones are replaced by next portals
+        RESULTS=\$(mktemp -d)
+        while [ "\$NEEDED" -gt 0 ] && [ \${#MISSING[@]} -gt 0 ]; do
+            BATCH=("\${MISSING[@]:0:\$NEEDED}")
+            MISSING=("\${MISSING[@]:\$NEEDED}")
+            for PORTAL in "\${BATCH[@]}"; do
+                (
+                    START=\$(date +%s%N)
+                    if timeout ${ISCSI_LOGIN_TIMEOUT:-30} sudo iscsiadm -m discovery -t sendtargets -p "\$PORTAL" >/dev/null &&
+                       timeout ${ISCSI_LOGIN_TIMEOUT:-30} sudo iscsiadm -m node -l all -p "\$PORTAL" >/dev/null; then
+                        STATUS=OK
+                    else
+                        STATUS=FAILED
+                    fi
+                    echo "\$STATUS \$(( (\$(date +%s%N) - START) / 1000000 ))" > "\$RESULTS/\$PORTAL"
+                ) &
+            done
+            wait
+
+            for PORTAL in "\${BATCH[@]}"; do
+                read STATUS TOOK < "\$RESULTS/\$PORTAL"
+                # syslog of the host keeps it, stderr reaches the driver log on failure
+                logger -s -t one-3par "iSCSI login to \$PORTAL: \$STATUS in \${TOOK}ms"
+                if [ "\$STATUS" = "OK" ]; then
+                    NEEDED=\$((NEEDED-1))
+                fi
+            done
+        done
+        rm -rf "\$RESULTS"
+
+        if [ "\$NEEDED" -gt 0 ]; then
+            echo "iSCSI login failed, \$NEEDED more sessions needed" >&2
+            exit 1
+        fi
 EOF
 }
 
@@ -161,25 +265,340 @@ EOF
 function remove_lun {
     local WWN
     WWN="$1"
+    remove_luns "$WWN"
+}
+
+function remove_luns {
+    local WWNS
+    WWNS="$1"
     cat <<EOF
-      DEV="/dev/disk/by-id/wwn-0x$WWN"
-      if DM_HOLDER=\$($SUDO $DMSETUP ls -o blkdevname | grep -Po "(?<=3$WWN\s\()[^)]+"); then
-          DM_SLAVE=\$(ls /sys/block/\${DM_HOLDER}/slaves)
-
-          $(multipath_flush "\$DEV")
-
-          unset device
-          for device in \${DM_SLAVE}
-          do
-              if [ -e /dev/\${device} ]; then
-                  $SUDO $BLOCKDEV --flushbufs /dev/\${device}
-                  echo 1 | $SUDO $TEE /sys/block/\${device}/device/delete
+      # Resolve multipath holders of all WWNs from one listing
+      DM_LIST=\$($SUDO $DMSETUP ls -o blkdevname)
+      RESULTS=\$(mktemp -d)
+
+      for WWN in $WWNS; do
+          (
+              if ! DM_HOLDER=\$(echo "\$DM_LIST" | grep -Po "(?<=3\$WWN\s\()[^)]+"); then
+                  echo "OK" > "\$RESULTS/\$WWN"
+                  exit 0
+              fi
+              DM_SLAVE=\$(ls /sys/block/\${DM_HOLDER}/slaves 2>/dev/null || true)
+
+              if ! $(multipath_flush "/dev/disk/by-id/wwn-0x\$WWN") >/dev/null 2>&1; then
+                  echo "FAILED multipath flush" > "\$RESULTS/\$WWN"
+                  exit 0
+              fi
+
+              # Flush and delete all paths at once
+              PIDS=()
+              for device in \${DM_SLAVE}; do
+                  (
+                      [ -e /dev/\${device} ] || exit 0
+                      $SUDO $BLOCKDEV --flushbufs /dev/\${device} &&
+                      echo 1 | $SUDO $TEE /sys/block/\${device}/device/delete >/dev/null
+                  ) &
+                  PIDS+=(\$!)
+              done
+              FAILED_SLAVES=""
+              for i in "\${!PIDS[@]}"; do
+                  wait "\${PIDS[\$i]}" || FAILED_SLAVES="\$FAILED_SLAVES \$(echo \$DM_SLAVE | cut -d' ' -f\$((i+1)))"
+              done
+
+              if [ -n "\$FAILED_SLAVES" ]; then
+                  echo "FAILED delete of\$FAILED_SLAVES" > "\$RESULTS/\$WWN"
+              else
+                  echo "OK" > "\$RESULTS/\$WWN"
               fi
-          done
+          ) &
+      done
+      wait
+
+      FAILED_WWNS=0
+      for WWN in $WWNS; do
+          if ! read STATUS < "\$RESULTS/\$WWN"; then
+              STATUS="FAILED unexpectedly"
+          fi
+          if [ "\$STATUS" != "OK" ]; then
+              echo "Remove of LUN \$WWN: \$STATUS" >&2
+              FAILED_WWNS=\$((FAILED_WWNS+1))
+          fi
+      done
+      rm -rf "\$RESULTS"
+
+      if [ "\$FAILED_WWNS" -gt 0 ]; then
+          exit 1
       fi
 EOF
 }
 
+function checkpoint_compress_cmd {
+    local COMPRESSION
+    COMPRESSION="$1"
+    case "$COMPRESSION" in
+        zstd) echo "zstd -q -c -T0 ${CHECKPOINT_COMPRESSION_LEVEL:--1}" ;;
+        lz4) echo "lz4 -q -c ${CHECKPOINT_COMPRESSION_LEVEL:--1}" ;;
+        gzip) echo "gzip -c ${CHECKPOINT_COMPRESSION_LEVEL:--1}" ;;
+    esac
+}
+
+# Stream image from stdin to VV, image formats which need random access are staged to file
+function stream_import {
+    local WWN
+    local STAGING
+    WWN="$1"
+    STAGING="$2"
+    cat <<EOF
+        set -e -o pipefail
+        DEV="/dev/disk/by-id/wwn-0x$WWN"
+        WORK=\$(mktemp -d)
+        trap "rm -rf \$WORK $STAGING" EXIT
+
+        START=\$(date +%s%N)
+
+        # image format by magic (qcow2, vmdk, qed, vpc, vhdx, vdi), raw is the fallback as in qemu-img probing
+        dd bs=64k count=1 iflag=fullblock of="\$WORK/head" 2>/dev/null
+        case "\$(head -c 4 "\$WORK/head" | od -An -tx1 | tr -d ' \\n')" in
+            514649fb|4b444d56|23204469|51454400|636f6e65|76686478|3c3c3c20) FORMAT=image ;;
+            *) FORMAT=raw ;;
+        esac
+
+        if [ "\$FORMAT" = "raw" ]; then
+            # zero blocks are skipped, new thin VV reads as zeros
+            cat "\$WORK/head" - | dd of="\$DEV" bs=${DD_BLOCK_SIZE:-64k} iflag=fullblock conv=${DD_CONV:-sparse} 2>"\$WORK/dd"
+            BYTES=\$(awk '/bytes/ {print \$1}' "\$WORK/dd")
+        else
+            cat "\$WORK/head" - > "$STAGING"
+            BYTES=\$(stat -c %s "$STAGING")
+            $QEMU_IMG convert -O raw "$STAGING" "\$DEV"
+        fi
+        sync
+        TOOK=\$(( (\$(date +%s%N) - START) / 1000000 + 1 ))
+
+        echo "Imported \$FORMAT image: \$((BYTES / 1048576)) MiB in \${TOOK}ms, \$((BYTES * 1000 / TOOK / 1048576)) MiB/s"
+EOF
+}
+
+# Compressed checkpoint layout on VV, exit code 2 when compressed data does not fit:
+# first 4MiB - header line "ONE_3PAR_CHECKPOINT <version> <compression> <data bytes> <xml bytes>" and domain XML
+# rest - compressed output of virsh save
+function checkpoint_save {
+    local DEPLOY_ID
+    local WWN
+    local COMPRESSION
+    DEPLOY_ID="$1"
+    WWN="$2"
+    COMPRESSION="$3"
+    cat <<EOF
+        set -e -o pipefail
+        DEV="/dev/disk/by-id/wwn-0x$WWN"
+        WORK=\$(mktemp -d)
+        trap "rm -rf \$WORK" EXIT
+        mkfifo "\$WORK/fifo"
+
+        virsh --connect $LIBVIRT_URI dumpxml --migratable $DEPLOY_ID > "\$WORK/xml"
+
+        START=\$(date +%s%N)
+        (
+            set -o pipefail
+            dd if="\$WORK/fifo" bs=4M 2>"\$WORK/raw" | $(checkpoint_compress_cmd "$COMPRESSION") | \
+                dd of="\$DEV" bs=4M seek=1 oflag=direct iflag=fullblock 2>"\$WORK/out"
+        ) &
+        PIPE=\$!
+
+        if ! virsh --connect $LIBVIRT_URI save --bypass-cache $DEPLOY_ID "\$WORK/fifo"; then
+            # unblock reader waiting for writer, read-write open does not block when reader is gone
+            : <> "\$WORK/fifo"
+            wait \$PIPE || true
+            FAILED=1
+        elif ! wait \$PIPE; then
+            FAILED=1
+        fi
+        if [ -n "\$FAILED" ]; then
+            # compressor did worse than expected, caller can retry with bigger VV
+            if grep -q "No space left on device" "\$WORK/out"; then
+                echo "Compressed checkpoint does not fit in \$((\$($SUDO $BLOCKDEV --getsize64 "\$DEV") / 1048576)) MiB VV" >&2
+                exit 2
+            fi
+            cat "\$WORK/out" >&2
+            exit 1
+        fi
+        TOOK=\$(( (\$(date +%s%N) - START) / 1000000 + 1 ))
+
+        RAW=\$(awk '/bytes/ {print \$1}' "\$WORK/raw")
+        DATA=\$(awk '/bytes/ {print \$1}' "\$WORK/out")
+        { echo "ONE_3PAR_CHECKPOINT 1 $COMPRESSION \$DATA \$(stat -c %s "\$WORK/xml")"; cat "\$WORK/xml"; } | \
+            dd of="\$DEV" bs=4M count=1 conv=sync,notrunc oflag=direct iflag=fullblock 2>/dev/null
+        sync
+
+        echo "Checkpoint saved: \$((RAW / 1048576)) MiB compressed to \$((DATA / 1048576)) MiB in \${TOOK}ms," \
+             "\$((RAW * 1000 / TOOK / 1048576)) MiB/s"
+EOF
+}
+
+function checkpoint_is_compressed {
+    local WWN
+    WWN="$1"
+    echo "dd if=/dev/disk/by-id/wwn-0x$WWN bs=4096 count=1 iflag=direct 2>/dev/null | head -c 19 | grep -q ONE_3PAR_CHECKPOINT"
+}
+
+function checkpoint_dumpxml {
+    local WWN
+    WWN="$1"
+    cat <<EOF
+        HEADER=\$(dd if=/dev/disk/by-id/wwn-0x$WWN bs=4M count=1 iflag=direct 2>/dev/null | tr -d '\\000')
+        echo "\${HEADER#*\$'\\n'}"
+EOF
+}
+
+function checkpoint_restore {
+    local WWN
+    local XML
+    WWN="$1"
+    XML="$2"
+    cat <<EOF
+        set -e -o pipefail
+        DEV="/dev/disk/by-id/wwn-0x$WWN"
+        WORK=\$(mktemp -d)
+        trap "rm -rf \$WORK" EXIT
+        mkfifo "\$WORK/fifo"
+
+        read MAGIC VERSION COMPRESSION DATA XML_SIZE < <(dd if="\$DEV" bs=4096 count=1 iflag=direct 2>/dev/null | head -n1)
+        case "\$COMPRESSION" in
+            zstd|lz4|gzip) ;;
+            *) echo "Unknown checkpoint compression \$COMPRESSION" >&2; exit 1 ;;
+        esac
+
+        # O_DIRECT reads must be aligned, so only whole blocks are read direct and the tail through page cache
+        BLOCKS=\$((DATA / 4194304))
+        START=\$(date +%s%N)
+        (
+            set -o pipefail
+            {
+                dd if="\$DEV" bs=4M skip=1 count=\$BLOCKS iflag=direct status=none &&
+                dd if="\$DEV" bs=4M skip=\$((BLOCKS + 1)) count=\$((DATA % 4194304)) iflag=count_bytes,fullblock status=none
+            } 2>"\$WORK/in" | \$COMPRESSION -q -d -c > "\$WORK/fifo"
+        ) &
+        PIPE=\$!
+
+        if ! virsh --connect $LIBVIRT_URI restore --bypass-cache "\$WORK/fifo" --xml $XML; then
+            pkill -P \$PIPE || true
+            cat "\$WORK/in" >&2
+            exit 1
+        fi
+        if ! wait \$PIPE; then
+            cat "\$WORK/in" >&2
+            exit 1
+        fi
+        TOOK=\$(( (\$(date +%s%N) - START) / 1000000 + 1 ))
+
+        echo "Checkpoint restored: \$((DATA / 1048576)) MiB compressed in \${TOOK}ms," \
+             "\$((DATA * 1000 / TOOK / 1048576)) MiB/s"
+EOF
+}
+
+# Timings of the stages of a driver action, call with empty name to end the last stage
+function stage {
+    local NOW
+    NOW=$(date +%s%N)
+    if [ -n "$STAGE_NAME" ]; then
+        STAGE_TIMINGS+=" $STAGE_NAME $(( (NOW - STAGE_START) / 1000000 ))ms"
+    fi
+    STAGE_NAME="$1"
+    STAGE_START=$NOW
+    STAGE_BEGIN=${STAGE_BEGIN:-$NOW}
+}
+
+function stage_log {
+    stage ""
+    log "$1 took $(( ($(date +%s%N) - STAGE_BEGIN) / 1000000 ))ms:$STAGE_TIMINGS"
+}
+
+# Run command only once for all driver instances sharing MV_STATE_DIR
+function mv_once {
+    local KEY="${1//[^A-Za-z0-9.-]/_}"
+    shift
+    if [ -z "$MV_STATE_DIR" ]; then
+        "$@"
+        return
+    fi
+    (
+        # lock fd can be inherited by ssh master connection, so unlock explicitly
+        trap "flock -u 9" EXIT
+        flock 9
+        [ -f "$MV_STATE_DIR/$KEY.done" ] && exit 0
+        "$@" && touch "$MV_STATE_DIR/$KEY.done"
+    ) 9>"$MV_STATE_DIR/$KEY.lock"
+}
+
+# Wait for one of MV_COPY_PARALLEL copy slots shared by driver instances
+function mv_copy_slot {
+    local I
+    [ -z "$MV_STATE_DIR" ] && return 0
+    while true; do
+        for ((I = 0; I < ${MV_COPY_PARALLEL:-2}; I++)); do
+            exec {MV_COPY_FD}>"$MV_STATE_DIR/copy.$I"
+            flock -n $MV_COPY_FD && return 0
+            exec {MV_COPY_FD}>&-
+        done
+        sleep 1
+    done
+}
+
+function mv_copy_slot_release {
+    [ -z "$MV_COPY_FD" ] && return 0
+    flock -u $MV_COPY_FD
+    exec {MV_COPY_FD}>&-
+    unset MV_COPY_FD
+}
+
+# Add command to EXIT trap, it runs before the commands already registered
+function trap_exit_add {
+    local COMMAND="$1"
+    local CURRENT
+    eval "set -- $(trap -p EXIT)"
+    CURRENT="$3"
+    trap "$COMMAND${CURRENT:+; $CURRENT}" EXIT
+}
+
+# Reuse one SSH connection per host for all commands of the driver action
+function ssh_mux_close {
+    local CONTROL
+    local HOST
+    if [ ${#SSH_TIMINGS[@]} -gt 0 ]; then
+        for HOST in "${!SSH_TIMINGS[@]}"; do
+            log "SSH commands on $HOST took:${SSH_TIMINGS[$HOST]}"
+        done
+    fi
+    for CONTROL in "$SSH_MUX_DIR"/*; do
+        [ -S "$CONTROL" ] && ssh -o ControlPath="$CONTROL" -O exit mux >/dev/null 2>&1
+    done
+    rm -rf "$SSH_MUX_DIR"
+}
+
+if [ "${SSH_MULTIPLEX:-YES}" = "YES" ] && [ -n "$SSH" ] && [[ "$SSH" != *ControlPath=* ]]; then
+    if [ -n "$SSH_MUX_DIR" ] && [ -d "$SSH_MUX_DIR" ]; then
+        # connections are shared with and closed by the parent driver instance
+        SSH="$SSH -o ControlMaster=auto -o ControlPath=$SSH_MUX_DIR/%C -o ControlPersist=${SSH_MULTIPLEX_PERSIST:-60}"
+    elif SSH_MUX_DIR=$(mktemp -d /tmp/one-3par-ssh.XXXXXX); then
+        # drivers register own EXIT commands with trap_exit_add to keep this one
+        SSH="$SSH -o ControlMaster=auto -o ControlPath=$SSH_MUX_DIR/%C -o ControlPersist=${SSH_MULTIPLEX_PERSIST:-60}"
+        trap_exit_add ssh_mux_close
+    fi
+fi
+
+# Collect per-command timings of commands run on hosts
+declare -A SSH_TIMINGS
+if declare -F ssh_exec_and_log >/dev/null && ! declare -F ssh_exec_and_log_untimed >/dev/null; then
+    eval "ssh_exec_and_log_untimed() $(declare -f ssh_exec_and_log | tail -n +2)"
+
+    function ssh_exec_and_log {
+        local START
+        START=$(date +%s%N)
+        ssh_exec_and_log_untimed "$@"
+        SSH_TIMINGS[$1]+=" $(( ($(date +%s%N) - START) / 1000000 ))ms"
+    }
+fi
+
 # Dummy ssh-agent function to support OpenNebula <5.12
 if ! declare -F ssh_forward >/dev/null; then
     ssh_forward(){ "$@"; }
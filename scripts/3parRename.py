@@ -2,7 +2,10 @@
 
 from hpe3parclient import client,exceptions
 import sys
+import threading
+import time
 from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
 
 parser = ArgumentParser()
 
@@ -11,6 +14,9 @@ parser.add_argument("-d", "--dry-run",action='store_true',dest="dryrun",help="Do
 parser.add_argument("-i", "--insecure",action='store_false',dest="secure",help="Allow insecure SSL")
 parser.add_argument("-p", "--port",action='store',default=8080,help="WSAPI Server Port number")
 parser.add_argument("-P", "--proto",default="https",help="WSAPI Server protocol [HTTP/HTTPS]")
+parser.add_argument("-j", "--journal",help="Journal of done renames, used to resume interrupted run [3parRename-<array>.journal]")
+parser.add_argument("-w", "--workers",type=int,default=4,help="Number of parallel rename calls")
+parser.add_argument("--rate",type=float,default=10,help="Maximum rename calls per second")
 parsed, args = parser.parse_known_args()
 #print(args)
 
@@ -36,7 +42,8 @@ except exceptions.HTTPUnauthorized as ex:
     exit(1)
 
 try:
-    print(cl.getStorageSystemInfo().get('name'))
+    systemName = cl.getStorageSystemInfo().get('name')
+    print(systemName)
     if parsed.dryrun:
         print("Dry run")
     else:
@@ -54,135 +61,189 @@ if  i != "y":
     cl.logout()
     exit()
 
+# names already handled by previous runs, journal line is: <array> <normal|reverse> <vv|vvset> <old name> <new name>
+mode = "reverse" if parsed.reverse else "normal"
+journalFile = parsed.journal or "3parRename-" + systemName + ".journal"
+done = set()
 try:
-    vvs = cl.getVolumes()
-    vvsets = cl.getVolumeSets()
+    with open(journalFile) as j:
+        for line in j:
+            parts = line.split()
+            if len(parts) != 5 or parts[0] != systemName or parts[1] != mode:
+                # names of other array or direction would skip renames that are still needed
+                print("Journal " + journalFile + " was not written by " + mode + " run on " + systemName +
+                      ", remove it or use another --journal")
+                cl.logout()
+                exit(1)
+            done.add(parts[3])
+            done.add(parts[4])
+    print("Resuming, " + str(len(done) // 2) + " renames in journal")
+except IOError:
+    pass
+
+# keep only names, not whole objects
+try:
+    vvNames = [vv.get('name') for vv in cl.getVolumes().get('members')]
+    vvsetNames = [vvset.get('name') for vvset in cl.getVolumeSets().get('members')]
 except Exception as ex:
     print(ex)
     exit(1)
 
+class RateLimiter:
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate > 0 else 0
+        self.next = time.time()
+        self.lock = threading.Lock()
+
+    def wait(self):
+        with self.lock:
+            now = time.time()
+            delay = self.next - now
+            self.next = max(now, self.next) + self.interval
+        if delay > 0:
+            time.sleep(delay)
+
+limiter = RateLimiter(parsed.rate)
+journalLock = threading.Lock()
+journal = None if parsed.dryrun else open(journalFile, "a")
+
 pr=False
 rejects = []
 rejectsSet = []
-def rename():
-    global pr
-    for vv in vvs.get('members'):
-        name=vv.get('name')
-        splitName = name.split('.')
-        if len(splitName) < 3:
-            rejects.append(vv.get('name'))
-            continue
-        if splitName[1] == "one":
-            del splitName[1]
-        else:
-            rejects.append(vv.get('name'))
-            continue;
-        pr=True
-        if splitName[len(splitName)-2] == "checkpoint":
-            splitName[len(splitName)-2]="cp"
-        if splitName[len(splitName)-1] == "vv":
-            del splitName[len(splitName)-1]
-        if splitName[len(splitName)-1].startswith("vv-"):
-            afterDash = splitName[len(splitName)-1].split('-')[1]
-            splitName[len(splitName)-2] += "-" + afterDash
-            del splitName[len(splitName)-1]
-        nameChanged = ".".join(splitName)
-        print(name + "->" + nameChanged)
-        if parsed.dryrun:
-            continue
-        try:
+stats = {'vv': 0, 'vvset': 0, 'failed': 0, 'skipped': 0}
+
+def newVVName(name):
+    splitName = name.split('.')
+    if len(splitName) < 3:
+        return None
+    if splitName[1] == "one":
+        del splitName[1]
+    else:
+        return None
+    if splitName[len(splitName)-2] == "checkpoint":
+        splitName[len(splitName)-2]="cp"
+    if splitName[len(splitName)-1] == "vv":
+        del splitName[len(splitName)-1]
+    if splitName[len(splitName)-1].startswith("vv-"):
+        afterDash = splitName[len(splitName)-1].split('-')[1]
+        splitName[len(splitName)-2] += "-" + afterDash
+        del splitName[len(splitName)-1]
+    return ".".join(splitName)
+
+def newVVSetName(name):
+    splitName = name.split('.')
+    if len(splitName) < 3:
+        return None
+    if splitName[1] == "one":
+        del splitName[1]
+    else:
+        return None
+    if splitName[len(splitName)-1] == "vvset":
+        del splitName[len(splitName)-1]
+    return ".".join(splitName)
+
+def newVVNameReverse(name):
+    splitName = name.split('.')
+    if len(splitName) < 2 or splitName[len(splitName)-1].startswith('vv'):
+        return None
+    if '' in splitName:
+        return None
+    splitName.insert(1,"one")
+    if splitName[len(splitName)-1] == "cp":
+        splitName[len(splitName)-1]="checkpoint"
+    if '-' in splitName[len(splitName)-1]:
+        last = splitName[len(splitName)-1].split('-')
+        splitName[len(splitName)-1]=last[0]
+        splitName.append("vv-" + last[1])
+    else:
+        splitName.append("vv")
+    return ".".join(splitName)
+
+def newVVSetNameReverse(name):
+    splitName = name.split('.')
+    if len(splitName) < 2 or splitName[len(splitName)-1].startswith('vv'):
+        return None
+    if '' in splitName:
+        return None
+    splitName.insert(1,"one")
+    splitName.insert(len(splitName),"vvset")
+    return ".".join(splitName)
+
+def renameOne(kind, name, nameChanged):
+    limiter.wait()
+    try:
+        if kind == "vv":
             cl.modifyVolume(name, {'newName':nameChanged})
-        # except exceptions.HTTPBadRequest:
-        # except exceptions.HTTPForbidden:
-        # except exceptions.HTTPInternalServerError:
-        # except exceptions.HTTPConflict:
-        except Exception as ex:
-            print(ex)
-
-    for vvset in vvsets.get('members'):
-        name=vvset.get('name')
-        splitName = name.split('.')
-        if len(splitName) < 3:
-            rejects.append(vvset.get('name'))
-            continue
-        if splitName[1] == "one":
-            del splitName[1]
         else:
-            rejects.append(vvset.get('name'))
-            continue;
-        pr=True
-        if splitName[len(splitName)-1] == "vvset":
-            del splitName[len(splitName)-1]
-        nameChanged = ".".join(splitName)
-        print(name + "->" + nameChanged)
-        if parsed.dryrun:
-            continue
-        try:
             cl.modifyVolumeSet(name, newName=nameChanged )
-        except Exception as ex:
-            print(ex)
-
-def renameReverse():
+    # except exceptions.HTTPBadRequest:
+    # except exceptions.HTTPForbidden:
+    # except exceptions.HTTPInternalServerError:
+    # except exceptions.HTTPConflict:
+    except Exception as ex:
+        print(name + ": " + str(ex))
+        with journalLock:
+            stats['failed'] += 1
+        return
+    with journalLock:
+        journal.write(systemName + " " + mode + " " + kind + " " + name + " " + nameChanged + "\n")
+        journal.flush()
+        stats[kind] += 1
+
+def renameAll(kind, names, newName, rejectList):
     global pr
-    for vv in vvs.get('members'):
-        name=vv.get('name')
-        splitName = name.split('.')
-        if len(splitName) < 2 or splitName[len(splitName)-1].startswith('vv'):
-            rejects.append(vv.get('name'))
-            continue
-        if '' in splitName:
-            rejects.append(vv.get('name'))
-            continue
-        pr=True
-        splitName.insert(1,"one")
-        if splitName[len(splitName)-1] == "cp":
-            splitName[len(splitName)-1]="checkpoint"
-        if '-' in splitName[len(splitName)-1]:
-            last = splitName[len(splitName)-1].split('-')
-            splitName[len(splitName)-1]=last[0]
-            splitName.append("vv-" + last[1])
-        else:
-            splitName.append("vv")
-        nameChanged = ".".join(splitName)
-        print(name + "->" + nameChanged)
-        if parsed.dryrun:
-            continue
+    futures = []
+    with ThreadPoolExecutor(max_workers=max(1, parsed.workers)) as executor:
+        for name in names:
+            if name in done:
+                stats['skipped'] += 1
+                continue
+            nameChanged = newName(name)
+            if nameChanged is None:
+                rejectList.append(name)
+                continue
+            pr=True
+            print(name + "->" + nameChanged)
+            if parsed.dryrun:
+                continue
+            futures.append((name, executor.submit(renameOne, kind, name, nameChanged)))
+
+    # unexpected errors, e.g. journal write, are raised from result
+    for name, future in futures:
         try:
-            cl.modifyVolume(name, {'newName':nameChanged})
-        except Exception as ex:
-            print(ex)
-
-    for vvset in vvsets.get('members'):
-        name=vvset.get('name')
-        splitName = name.split('.')
-        if len(splitName) < 2 or splitName[len(splitName)-1].startswith('vv'):
-            rejects.append(vvset.get('name'))
-            continue
-        if '' in splitName:
-            rejects.append(vvset.get('name'))
-            continue
-        pr=True
-        splitName.insert(1,"one")
-        splitName.insert(len(splitName),"vvset")
-        nameChanged = ".".join(splitName)
-        print(name + "->" + nameChanged)
-        if parsed.dryrun:
-            continue
-        try:
-            cl.modifyVolumeSet(name, newName=nameChanged )
+            future.result()
         except Exception as ex:
-            print(ex)
+            print(name + ": " + str(ex))
+            stats['failed'] += 1
 
+def rename():
+    renameAll("vv", vvNames, newVVName, rejects)
+    renameAll("vvset", vvsetNames, newVVSetName, rejects)
+
+def renameReverse():
+    renameAll("vv", vvNames, newVVNameReverse, rejects)
+    renameAll("vvset", vvsetNames, newVVSetNameReverse, rejects)
+
+start = time.time()
 if parsed.reverse:
     print("reverse")
     renameReverse()
 else:
     print("normal")
     rename()
+took = time.time() - start
 
 if pr:
     print("\n\nRejects")
     print(rejects)
     print(rejectsSet)
 
+renamed = stats['vv'] + stats['vvset']
+print("\nRenamed " + str(stats['vv']) + " VVs and " + str(stats['vvset']) + " VV sets in " + "%.1f" % took + "s (" +
+      "%.1f" % (renamed / took if took > 0 else 0) + "/s), failed " + str(stats['failed']) +
+      ", skipped from journal " + str(stats['skipped']))
+
+if journal:
+    journal.close()
+
 cl.logout()
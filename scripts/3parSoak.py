@@ -0,0 +1,496 @@
+#!/usr/bin/python3
+
+# Soak test of concurrent 3par.py actions against local WSAPI stand-in.
+# Runs mass deploy (clone -> addVolumeToVVSet -> createQosPolicy -> setupHost -> exportVV)
+# and mass teardown of many VMs at once, like OpenNebula does, and reports latencies,
+# conflicts and WSAPI session usage.
+
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import unquote, urlsplit
+
+parser = ArgumentParser()
+
+parser.add_argument("-v", "--vms", type=int, default=100, help="Number of VMs deployed and terminated at once")
+parser.add_argument("-d", "--disks", type=int, default=2,
+                    help="Number of disks per VM, deployed in parallel like tm/3par/mv does")
+parser.add_argument("-H", "--hosts", type=int, default=8, help="Number of hypervisors VMs are spread over")
+parser.add_argument("-r", "--rounds", type=int, default=1, help="Number of deploy and teardown rounds")
+parser.add_argument("-l", "--latency", type=float, default=20, help="Mean WSAPI call latency in ms")
+parser.add_argument("-j", "--jitter", type=float, default=0.5, help="Latency jitter as fraction of mean")
+parser.add_argument("-sl", "--serial-latency", type=float, default=10, dest="serialLatency",
+                    help="Latency in ms of volume create/copy/delete, which are serialized on the array")
+parser.add_argument("-cr", "--conflict-rate", type=float, default=0.05, dest="conflictRate",
+                    help="Probability of spurious conflict on copy and export")
+parser.add_argument("-ct", "--copy-time", type=float, default=2, dest="copyTime",
+                    help="Seconds physical copy runs, volume can not be deleted meanwhile")
+parser.add_argument("-ms", "--max-sessions", type=int, default=0, dest="maxSessions",
+                    help="Maximum of WSAPI sessions at once, 0 for unlimited")
+parser.add_argument("-gs", "--governor-slots", type=int, default=0, dest="governorSlots",
+                    help="WSAPI_MAX_INFLIGHT passed to 3par.py, 0 disables governor")
+parser.add_argument("--max-p99", type=float, default=0, dest="maxP99",
+                    help="Fail when p99 latency of any task in seconds exceeds this, 0 disables")
+parsed = parser.parse_args()
+
+driver = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "datastore", "3par", "3par.py")
+
+# tasks which result is ignored by drivers
+ignoredTasks = ["deleteHost"]
+
+
+class Array:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.serialLock = threading.Lock()
+        self.volumes = {}
+        self.volumeSets = {}
+        self.qos = {}
+        self.hosts = {}
+        self.vluns = {}
+        self.busyHosts = set()
+        self.sessions = set()
+        self.nextId = 1
+        self.stats = {'requests': 0, 'logins': 0, 'logouts': 0, 'peakSessions': 0, 'rejectedLogins': 0,
+                      'unauthenticated': 0, 'serialWait': 0.0}
+        self.conflicts = {}
+        self.times = []
+
+    def newVolume(self, name, sizeMiB):
+        self.nextId += 1
+        return {'name': name, 'id': self.nextId, 'wwn': '60002AC0000000000000%012X' % self.nextId, 'sizeMiB': sizeMiB,
+                'copyType': 1, 'userSpace': {'usedMiB': 0}, 'snapshotSpace': {'usedMiB': 0}, 'busyUntil': 0,
+                'copies': [], 'meta': {}}
+
+    def conflict(self, kind):
+        self.conflicts[kind] = self.conflicts.get(kind, 0) + 1
+        return 409, {'code': 32, 'desc': '{kind} conflict'.format(kind=kind)}
+
+    def busy(self, name):
+        vv = self.volumes[name]
+        now = time.time()
+        vv['copies'] = [copy for copy in vv['copies'] if self.volumes.get(copy, {}).get('busyUntil', 0) > now]
+        return vv['busyUntil'] > now or len(vv['copies']) > 0
+
+    def serialized(self):
+        # volume operations are processed one by one on the array
+        start = time.time()
+        self.serialLock.acquire()
+        self.stats['serialWait'] += time.time() - start
+        time.sleep(parsed.serialLatency / 1000.0)
+        self.serialLock.release()
+
+
+array = Array()
+notFound = (404, {'code': 23, 'desc': 'not found'})
+
+
+class Handler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def reply(self, status, body=None, location=None):
+        data = json.dumps(body).encode('utf-8') if body is not None else b''
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        if location:
+            self.send_header('Location', location)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def handle_one(self, method):
+        url = urlsplit(self.path)
+        path = url.path[len('/api/v1'):] if url.path.startswith('/api/v1') else url.path
+        parts = [unquote(part) for part in path.strip('/').split('/')]
+        query = unquote(url.query)[len('query='):].strip('"')
+        length = int(self.headers.get('Content-Length') or 0)
+        body = json.loads(self.rfile.read(length)) if length else {}
+
+        mean = parsed.latency / 1000.0
+        time.sleep(max(0.0, random.uniform(mean * (1 - parsed.jitter), mean * (1 + parsed.jitter))))
+
+        with array.lock:
+            array.stats['requests'] += 1
+
+        if parts[0] == 'api':
+            return self.reply(200, {'major': 1, 'minor': 10, 'build': 30201256})
+
+        if parts[0] == 'credentials':
+            with array.lock:
+                if method == 'POST':
+                    if parsed.maxSessions and len(array.sessions) >= parsed.maxSessions:
+                        array.stats['rejectedLogins'] += 1
+                        return self.reply(503, {'code': 198, 'desc': 'too many sessions'})
+                    key = '%032x' % random.getrandbits(128)
+                    array.sessions.add(key)
+                    array.stats['logins'] += 1
+                    array.stats['peakSessions'] = max(array.stats['peakSessions'], len(array.sessions))
+                    return self.reply(201, {'key': key})
+                array.sessions.discard(parts[1])
+                array.stats['logouts'] += 1
+                return self.reply(200)
+
+        with array.lock:
+            if self.headers.get('X-Hp3Par-Wsapi-Sessionkey') not in array.sessions:
+                array.stats['unauthenticated'] += 1
+                return self.reply(403, {'code': 6, 'desc': 'invalid session key'})
+
+        handler = getattr(self, '{method}_{kind}'.format(method=method.lower(), kind=parts[0]), None)
+        if handler is None:
+            return self.reply(400, {'code': 29, 'desc': 'not modelled: {method} {path}'.format(method=method, path=path)})
+        result = handler(parts[1:], query, body)
+        self.reply(*result)
+
+    def handle_timed(self, method):
+        start = time.time()
+        self.handle_one(method)
+        with array.lock:
+            array.times.append(time.time() - start)
+
+    def do_GET(self):
+        self.handle_timed('GET')
+
+    def do_POST(self):
+        self.handle_timed('POST')
+
+    def do_PUT(self):
+        self.handle_timed('PUT')
+
+    def do_DELETE(self):
+        self.handle_timed('DELETE')
+
+    # volumes
+    def get_volumes(self, parts, query, body):
+        with array.lock:
+            if not parts:
+                return 200, {'members': [self.volume(vv) for vv in array.volumes.values()]}
+            vv = array.volumes.get(parts[0])
+            if vv is None:
+                return notFound
+            if len(parts) == 1:
+                return 200, self.volume(vv)
+            if len(parts) == 2:
+                return 200, {'members': [{'key': k, 'value': v} for k, v in vv['meta'].items()]}
+            if parts[2] not in vv['meta']:
+                return notFound
+            return 200, {'key': parts[2], 'value': vv['meta'][parts[2]]}
+
+    def volume(self, vv):
+        return dict((k, v) for k, v in vv.items() if k not in ['busyUntil', 'copies', 'meta'])
+
+    def post_volumes(self, parts, query, body):
+        if len(parts) == 2:
+            with array.lock:
+                if parts[0] not in array.volumes:
+                    return notFound
+                if body.get('key') in array.volumes[parts[0]]['meta']:
+                    return array.conflict('metadata')
+                array.volumes[parts[0]]['meta'][body.get('key')] = body.get('value')
+            return 200, None
+
+        array.serialized()
+        with array.lock:
+            if not parts:
+                if body.get('name') in array.volumes:
+                    return array.conflict('createVolume')
+                array.volumes[body.get('name')] = array.newVolume(body.get('name'), body.get('sizeMiB'))
+                return 201, None
+
+            src = array.volumes.get(parts[0])
+            dest = array.volumes.get(body.get('parameters', {}).get('destVolume'))
+            if src is None or dest is None:
+                return notFound
+            if random.random() < parsed.conflictRate or array.busy(dest['name']):
+                return array.conflict('copyVolume')
+            dest['busyUntil'] = time.time() + parsed.copyTime
+            src['copies'].append(dest['name'])
+            array.nextId += 1
+            return 201, {'taskid': array.nextId}
+
+    def put_volumes(self, parts, query, body):
+        with array.lock:
+            vv = array.volumes.get(parts[0])
+            if vv is None:
+                return notFound
+            if len(parts) == 3:
+                vv['meta'][parts[2]] = body.get('value')
+            elif body.get('action') == 3:
+                vv['sizeMiB'] += body.get('sizeMiB')
+            elif body.get('newName'):
+                array.volumes[body.get('newName')] = array.volumes.pop(parts[0])
+                vv['name'] = body.get('newName')
+            return 200, None
+
+    def delete_volumes(self, parts, query, body):
+        if len(parts) == 3:
+            with array.lock:
+                if parts[2] not in array.volumes.get(parts[0], {}).get('meta', {}):
+                    return notFound
+                del array.volumes[parts[0]]['meta'][parts[2]]
+            return 200, None
+
+        array.serialized()
+        with array.lock:
+            if parts[0] not in array.volumes:
+                return notFound
+            if array.busy(parts[0]) or any(vlun['volumeName'] == parts[0] for vlun in array.vluns.values()):
+                return array.conflict('deleteVolume')
+            del array.volumes[parts[0]]
+            return 200, None
+
+    # volume sets and QoS
+    def get_volumesets(self, parts, query, body):
+        with array.lock:
+            if parts[0] not in array.volumeSets:
+                return notFound
+            return 200, {'name': parts[0], 'setmembers': list(array.volumeSets[parts[0]])}
+
+    def post_volumesets(self, parts, query, body):
+        with array.lock:
+            if body.get('name') in array.volumeSets:
+                return array.conflict('createVolumeSet')
+            array.volumeSets[body.get('name')] = list(body.get('setmembers') or [])
+            return 201, None
+
+    def put_volumesets(self, parts, query, body):
+        with array.lock:
+            members = array.volumeSets.get(parts[0])
+            if members is None:
+                return notFound
+            for member in body.get('setmembers', []):
+                if body.get('action') == 1:
+                    if member in members:
+                        return array.conflict('addToVolumeSet')
+                    members.append(member)
+                elif body.get('action') == 2:
+                    if member not in members:
+                        return notFound
+                    members.remove(member)
+            return 200, None
+
+    def delete_volumesets(self, parts, query, body):
+        with array.lock:
+            if array.volumeSets.pop(parts[0], None) is None:
+                return notFound
+            # QoS rule goes away with its VV set
+            array.qos.pop(parts[0], None)
+            return 200, None
+
+    def get_qos(self, parts, query, body):
+        with array.lock:
+            rule = array.qos.get(parts[0].split(':', 1)[1])
+            return (200, rule) if rule is not None else notFound
+
+    def post_qos(self, parts, query, body):
+        with array.lock:
+            if body.get('name') in array.qos:
+                return array.conflict('createQoS')
+            array.qos[body.get('name')] = body
+            return 201, None
+
+    def put_qos(self, parts, query, body):
+        with array.lock:
+            rule = array.qos.get(parts[0].split(':', 1)[1])
+            if rule is None:
+                return notFound
+            rule.update(body)
+            return 200, None
+
+    def delete_qos(self, parts, query, body):
+        with array.lock:
+            if array.qos.pop(parts[0].split(':', 1)[1], None) is None:
+                return notFound
+            return 200, None
+
+    # hosts, VLUNs and ports
+    def get_hosts(self, parts, query, body):
+        with array.lock:
+            if not parts:
+                return 200, {'members': list(array.hosts.values())}
+            host = array.hosts.get(parts[0])
+            return (200, host) if host is not None else notFound
+
+    def post_hosts(self, parts, query, body):
+        with array.lock:
+            if body.get('name') in array.hosts:
+                return array.conflict('createHost')
+            array.hosts[body.get('name')] = {'name': body.get('name'), 'iSCSIPaths': [
+                {'name': name, 'portPos': {'node': i % 2, 'slot': 2, 'cardPort': 1}}
+                for i, name in enumerate(body.get('iSCSINames', []))]}
+        return 201, None, '/api/v1/hosts/{name}'.format(name=body.get('name'))
+
+    def put_hosts(self, parts, query, body):
+        with array.lock:
+            return (200, None) if parts[0] in array.hosts else notFound
+
+    def delete_hosts(self, parts, query, body):
+        with array.lock:
+            if parts[0] not in array.hosts:
+                return notFound
+            if any(vlun['hostname'] == parts[0] for vlun in array.vluns.values()):
+                return array.conflict('deleteHost')
+            del array.hosts[parts[0]]
+            return 200, None
+
+    def get_vluns(self, parts, query, body):
+        with array.lock:
+            members = list(array.vluns.values())
+        for condition in query.split(' OR ') if query else []:
+            key, _, value = condition.split(' ', 2)
+            members = [vlun for vlun in members if vlun.get(key) == value]
+        return 200, {'members': members}
+
+    def post_vluns(self, parts, query, body):
+        host = body.get('hostname')
+        with array.lock:
+            if body.get('volumeName') not in array.volumes or host not in array.hosts:
+                return notFound
+            # LUN number is picked by the array, parallel exports to one host collide
+            if random.random() < parsed.conflictRate or host in array.busyHosts:
+                return array.conflict('createVLUN')
+            array.busyHosts.add(host)
+        time.sleep(parsed.latency / 1000.0)
+        with array.lock:
+            array.busyHosts.discard(host)
+            used = [vlun['lun'] for vlun in array.vluns.values() if vlun['hostname'] == host]
+            lun = min(set(range(len(used) + 1)) - set(used))
+            key = '{name},{lun},{host}'.format(name=body.get('volumeName'), lun=lun, host=host)
+            array.vluns[key] = {'volumeName': body.get('volumeName'), 'lun': lun, 'hostname': host, 'active': True}
+        return 201, None, '/api/v1/vluns/{key}'.format(key=key)
+
+    def delete_vluns(self, parts, query, body):
+        with array.lock:
+            if array.vluns.pop(parts[0], None) is None:
+                return notFound
+            return 200, None
+
+    def get_ports(self, parts, query, body):
+        return 200, {'members': [{'portPos': {'node': node, 'slot': 2, 'cardPort': port}, 'type': 8, 'protocol': 2,
+                                  'IPAddr': '10.0.{node}.{port}'.format(node=node, port=port)}
+                                 for node in range(2) for port in range(1, 3)]}
+
+    def get_tasks(self, parts, query, body):
+        return 200, {'id': int(parts[0]), 'status': 1}
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[int(round(q * (len(values) - 1)))] if values else 0.0
+
+
+results = []
+resultsLock = threading.Lock()
+
+
+def run(phase, task, *taskArgs):
+    start = time.time()
+    proc = subprocess.run([sys.executable, driver, task, '-a', api, '-i', '127.0.0.1', '-s', 'NO', '-u', 'soak',
+                           '-p', 'soak'] + list(taskArgs), stdout=subprocess.PIPE, stderr=subprocess.STDOUT, env=env)
+    took = time.time() - start
+    output = proc.stdout.decode('utf-8', 'replace').strip()
+    with resultsLock:
+        results.append({'phase': phase, 'task': task, 'took': took, 'rc': proc.returncode, 'output': output})
+    return proc.returncode == 0, output
+
+
+def deploy(vmId):
+    run('deploy', 'getIscsiPortals', '--sort', 'YES')
+    # disks of one VM are set up at once, so they race on creation of VM VV set and QoS rule
+    with ThreadPoolExecutor(max_workers=max(1, parsed.disks)) as diskExecutor:
+        list(diskExecutor.map(lambda diskId: deployDisk(vmId, diskId), range(parsed.disks)))
+
+
+def deployDisk(vmId, diskId):
+    host = 'soak-host-{host}'.format(host=vmId % parsed.hosts)
+    ok, nameWwn = run('deploy', 'createVmClone', '-sn', 'soak.0', '-nt', 'soak', '-id', str(diskId), '-vi',
+                      str(vmId), '-sz', '1024', '-c', 'SOAK_CPG')
+    if not ok:
+        return
+    name = nameWwn.splitlines()[-1].split(':')[0]
+    run('deploy', 'addVolumeToVVSet', '-nt', 'soak', '-vi', str(vmId), '-n', name)
+    run('deploy', 'createQosPolicy', '-nt', 'soak', '-vi', str(vmId), '-n', name, '-qp', 'NORMAL', '-qxi', '1000',
+        '-qmi', '0', '-qxb', '0', '-qmb', '0', '-ql', '0')
+    run('deploy', 'setupHost', '-hs', host, '-in', 'iqn.2005-03.org.open-iscsi:{host}'.format(host=host))
+    run('deploy', 'exportVV', '-n', name, '-hs', host)
+
+
+def teardown(vmId):
+    host = 'soak-host-{host}'.format(host=vmId % parsed.hosts)
+    for diskId in range(parsed.disks):
+        name = 'soak.vm.{vmId}.{diskId}'.format(vmId=vmId, diskId=diskId)
+        run('teardown', 'unexportVV', '-n', name, '-hs', host)
+        run('teardown', 'deleteHost', '-hs', host)
+        run('teardown', 'deleteQosPolicy', '-nt', 'soak', '-vi', str(vmId), '-n', name)
+        run('teardown', 'deleteVolumeFromVVSet', '-nt', 'soak', '-vi', str(vmId), '-n', name)
+        run('teardown', 'deleteVmClone', '-nt', 'soak', '-id', str(diskId), '-vi', str(vmId))
+
+
+server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+server.daemon_threads = True
+threading.Thread(target=server.serve_forever, daemon=True).start()
+api = 'http://127.0.0.1:{port}/api/v1'.format(port=server.server_address[1])
+array.volumes['soak.0'] = array.newVolume('soak.0', 1024)
+
+# caches and governor state of 3par.py are kept apart from real ones
+env = dict(os.environ, TMPDIR=tempfile.mkdtemp(prefix='3parSoak.'), WSAPI_MAX_INFLIGHT=str(parsed.governorSlots))
+
+print("Stand-in WSAPI " + api + ", " + str(parsed.vms) + " VMs x " + str(parsed.disks) + " disks on " +
+      str(parsed.hosts) + " hosts, " + str(parsed.rounds) + " rounds")
+
+phaseTimes = {'deploy': 0.0, 'teardown': 0.0}
+with ThreadPoolExecutor(max_workers=max(1, parsed.vms)) as executor:
+    for i in range(parsed.rounds):
+        for phase, func in [('deploy', deploy), ('teardown', teardown)]:
+            start = time.time()
+            list(executor.map(func, range(parsed.vms)))
+            phaseTimes[phase] += time.time() - start
+
+server.shutdown()
+
+# report
+failed = False
+print("\n%-10s %-22s %6s %6s %8s %8s %8s" % ("PHASE", "TASK", "CALLS", "FAILED", "P50", "P99", "MAX"))
+for phase in ['deploy', 'teardown']:
+    tasks = []
+    for result in results:
+        if result['phase'] == phase and result['task'] not in tasks:
+            tasks.append(result['task'])
+    for task in tasks:
+        taskResults = [result for result in results if result['phase'] == phase and result['task'] == task]
+        times = [result['took'] for result in taskResults]
+        errors = [result for result in taskResults if result['rc'] != 0]
+        p99 = percentile(times, 0.99)
+        print("%-10s %-22s %6d %6d %7.2fs %7.2fs %7.2fs%s" % (phase, task, len(times), len(errors),
+              percentile(times, 0.5), p99, max(times), " (ignored)" if task in ignoredTasks and errors else ""))
+        if errors and task not in ignoredTasks:
+            failed = True
+            print("    " + (errors[0]['output'].splitlines() or [''])[-1])
+        if parsed.maxP99 and p99 > parsed.maxP99:
+            failed = True
+    print("%-10s took %.1fs" % (phase, phaseTimes[phase]))
+
+print("\nCONFLICTS " + " ".join("%s=%d" % item for item in sorted(array.conflicts.items())) if array.conflicts
+      else "\nCONFLICTS none")
+print("SESSIONS LOGINS=%d LOGOUTS=%d PEAK=%d LEAKED=%d REJECTED=%d UNAUTHENTICATED=%d" % (
+    array.stats['logins'], array.stats['logouts'], array.stats['peakSessions'], len(array.sessions),
+    array.stats['rejectedLogins'], array.stats['unauthenticated']))
+print("REQUESTS=%d PER_SESSION=%.1f P50=%.0fms P99=%.0fms SERIAL_WAIT=%.1fs" % (
+    array.stats['requests'], array.stats['requests'] / float(max(1, array.stats['logins'])),
+    percentile(array.times, 0.5) * 1000, percentile(array.times, 0.99) * 1000, array.stats['serialWait']))
+
+leftover = {'volumes': len(array.volumes) - 1, 'vvsets': len(array.volumeSets), 'qos': len(array.qos),
+            'hosts': len(array.hosts), 'vluns': len(array.vluns)}
+print("LEFTOVER " + " ".join("%s=%d" % item for item in sorted(leftover.items())))
+if any(leftover.values()) or array.sessions:
+    failed = True
+
+exit(1 if failed else 0)